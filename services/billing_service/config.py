@@ -48,7 +48,15 @@ class BillingServiceConfig(BaseSettings):
     
     # Usage tracking
     usage_aggregation_interval: int = 300  # 5 minutes in seconds
+    usage_aggregation_workers: int = 8  # Tenants whose metrics are calculated concurrently
     usage_retention_days: int = 90
+    usage_cache_max_size: int = 10000  # Max tenants kept in the usage cache
+    usage_cache_ttl: int = 300  # 5 minutes in seconds
+    usage_flush_interval_ms: int = 500  # How often queued usage events are written
+    usage_write_batch_size: int = 1000  # Max usage events per bulk insert
+    usage_flush_max_backoff: int = 60  # Max seconds between retries while writes keep failing
+    usage_queue_warn_size: int = 50000  # Warn when this many usage events are waiting to be written
+    usage_dead_letter_size: int = 1000  # Rejected usage rows kept in memory for inspection
     
     # Cost calculation
     cost_per_storage_gb: float = 0.10  # $0.10 per GB per month
@@ -15,7 +15,11 @@ from shared.models.billing_models import BillingPlan
 
 from services.billing_service.config import config
 from services.billing_service.tracking.usage_tracker import usage_tracker
-from services.billing_service.tracking.cost_calculator import cost_calculator
+from services.billing_service.tracking.cost_calculator import (
+    cost_calculator,
+    warm_plan_cache,
+    invalidate_plan_cache
+)
 from services.billing_service.tracking.budget_enforcer import budget_enforcer
 from services.billing_service.alerts.alert_manager import alert_manager
 
@@ -34,6 +38,9 @@ async def lifespan(app: FastAPI):
         # Create default billing plans if they don't exist
         create_default_billing_plans()
         
+        # Cache billing plans for cost calculations
+        warm_billing_plan_cache()
+        
     except Exception as e:
         logger.error(f"Database initialization failed: {str(e)}")
     
@@ -169,6 +176,16 @@ def create_default_billing_plans():
     
     db.commit()
     logger.info("Created default billing plans")
+    
+    invalidate_plan_cache()
+
+
+def warm_billing_plan_cache():
+    """Load billing plans into the cost calculator's plan cache."""
+    from shared.database.session import db_session_scope
+    
+    with db_session_scope() as db:
+        warm_plan_cache(db)
 
 
 def setup_message_consumers():
@@ -75,7 +75,8 @@ async def get_usage_history(
     try:
         usage_data = usage_tracker.get_tenant_usage(
             tenant_id=UUID(tenant_id),
-            timeframe=timeframe
+            timeframe=timeframe,
+            include_history=True
         )
         
         # Filter by metric if specified
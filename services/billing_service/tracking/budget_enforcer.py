@@ -7,7 +7,7 @@ from datetime import datetime, timedelta
 from typing import Dict, List, Any, Optional
 from uuid import UUID
 
-from sqlalchemy.orm import Session
+from sqlalchemy.orm import Session, joinedload
 
 from shared.database.session import get_db
 from shared.models.billing_models import Subscription
@@ -60,15 +60,17 @@ class BudgetEnforcer:
         db: Session = next(get_db())
         
         try:
-            # Get all active subscriptions
-            subscriptions = db.query(Subscription).filter(
-                Subscription.status == 'active'
-            ).all()
+            # Get tenants with an active subscription (only the tenant_id column is needed)
+            tenant_ids = [
+                tid for (tid,) in db.query(Subscription.tenant_id).filter(
+                    Subscription.status == 'active'
+                ).all()
+            ]
             
-            for subscription in subscriptions:
-                self.check_tenant_budget(subscription.tenant_id)
+            for tenant_id in tenant_ids:
+                self.check_tenant_budget(tenant_id)
             
-            logger.debug(f"Checked budgets for {len(subscriptions)} tenants")
+            logger.debug(f"Checked budgets for {len(tenant_ids)} tenants")
             
         except Exception as e:
             logger.error(f"Error checking budgets: {str(e)}")
@@ -90,7 +92,9 @@ class BudgetEnforcer:
             
             # Check subscription for budget
             db: Session = next(get_db())
-            subscription = db.query(Subscription).filter(
+            subscription = db.query(Subscription).options(
+                joinedload(Subscription.billing_plan)
+            ).filter(
                 Subscription.tenant_id == tenant_id,
                 Subscription.status == 'active'
             ).first()
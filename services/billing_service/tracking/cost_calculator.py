@@ -6,21 +6,95 @@ from typing import Dict, List, Any, Optional, Tuple
 from uuid import UUID
 from decimal import Decimal
 
-from sqlalchemy.orm import Session
-from sqlalchemy import func, and_
+from sqlalchemy.orm import Session, joinedload
+from sqlalchemy import func, and_, case, literal
 
-from shared.database.session import get_db
+from shared.database.session import db_session_scope
+from shared.database.query_counter import query_budget
 from shared.models.billing_models import BillingPlan, Subscription, UsageRecord
 from shared.utils.logging import logger
 from services.billing_service.config import config
 
 
+# Proration divisor for monthly plan prices
+DAYS_PER_MONTH = Decimal(30)
+
+# Bytes per GB, as a float so SQL performs a non-integer division
+BYTES_PER_GB = 1073741824.0
+
+# Plan-limited metrics billed for overage, one entry per metric:
+# (quantity key, plan limit attribute, config rate attribute, prorated,
+#  overage_costs key, overage field, rate field, usage_percentages key)
+OVERAGE_SPEC = (
+    ('storage_gb', 'max_storage_gb', 'cost_per_storage_gb', True,
+     'storage', 'overage_gb', 'rate_per_gb', 'storage'),
+    ('file_uploads', 'max_files_per_month', 'cost_per_file_upload', False,
+     'file_uploads', 'overage_files', 'rate_per_file', 'files'),
+    ('api_calls', 'max_api_calls', 'cost_per_api_call', False,
+     'api_calls', 'overage_calls', 'rate_per_call', 'api_calls'),
+)
+
+
+# Active billing plans keyed by lowercase name, plus the default free plan
+# under FREE_PLAN_KEY. Entries are detached from their session.
+_PLAN_CACHE: Dict[str, BillingPlan] = {}
+FREE_PLAN_KEY = 'free'
+
+
+def _free_plan_query(db: Session):
+    """Query for the default free billing plan."""
+    return db.query(BillingPlan).filter(
+        BillingPlan.is_default == True,
+        BillingPlan.price_per_month == 0
+    )
+
+
+def _load_free_plan(db: Session) -> Optional[BillingPlan]:
+    """Load the default free plan from the database and cache it."""
+    free_plan = _free_plan_query(db).first()
+    if free_plan:
+        db.expunge(free_plan)
+        _PLAN_CACHE[FREE_PLAN_KEY] = free_plan
+    return free_plan
+
+
+def warm_plan_cache(db: Session) -> None:
+    """Load all active billing plans into the plan cache."""
+    plans = db.query(BillingPlan).filter(BillingPlan.is_active == True).all()
+    
+    cache = {}
+    for plan in plans:
+        db.expunge(plan)
+        cache[plan.name.lower()] = plan
+        if plan.is_default and plan.price_per_month == 0:
+            cache[FREE_PLAN_KEY] = plan
+    
+    _PLAN_CACHE.clear()
+    _PLAN_CACHE.update(cache)
+    logger.info(f"Cached {len(plans)} billing plans")
+
+
+def invalidate_plan_cache() -> None:
+    """Drop cached billing plans after plans are created or modified."""
+    _PLAN_CACHE.clear()
+
+
+def _to_decimal(value: Any) -> Decimal:
+    """Convert a numeric value to Decimal without binary float artifacts."""
+    if isinstance(value, Decimal):
+        return value
+    if isinstance(value, float):
+        return Decimal(str(value))
+    return Decimal(value or 0)
+
+
 class CostCalculator:
     """Calculates costs based on usage and billing plans."""
     
     def __init__(self):
         pass
     
+    @query_budget(max_queries=5)
     def calculate_tenant_cost(
         self,
         tenant_id: UUID,
@@ -38,43 +112,42 @@ class CostCalculator:
         Returns:
             Cost calculation details
         """
-        db: Session = next(get_db())
-        
-        try:
-            # Default to current month
-            if not start_date:
-                start_date = datetime.now().replace(day=1, hour=0, minute=0, second=0, microsecond=0)
-            if not end_date:
-                end_date = datetime.now()
+        with db_session_scope() as db:
+            try:
+                # Default to current month
+                if not start_date:
+                    start_date = datetime.now().replace(day=1, hour=0, minute=0, second=0, microsecond=0)
+                if not end_date:
+                    end_date = datetime.now()
+                
+                # Get tenant's subscription, loading its plan in the same query
+                subscription = db.query(Subscription).options(
+                    joinedload(Subscription.billing_plan)
+                ).filter(
+                    Subscription.tenant_id == tenant_id,
+                    Subscription.status == 'active'
+                ).first()
+                
+                if not subscription:
+                    return self._calculate_free_tier_cost(db, tenant_id, start_date, end_date)
+                
+                # Get usage for period
+                usage = self._get_usage_for_period(db, tenant_id, start_date, end_date)
+                
+                # Calculate costs based on plan
+                if subscription.billing_plan.price_per_month == 0:
+                    # Free tier
+                    return self._calculate_free_tier_cost(db, tenant_id, start_date, end_date, usage)
+                else:
+                    # Paid tier
+                    return self._calculate_paid_tier_cost(db, tenant_id, subscription, start_date, end_date, usage)
             
-            # Get tenant's subscription
-            subscription = db.query(Subscription).filter(
-                Subscription.tenant_id == tenant_id,
-                Subscription.status == 'active'
-            ).first()
-            
-            if not subscription:
-                return self._calculate_free_tier_cost(db, tenant_id, start_date, end_date)
-            
-            # Get usage for period
-            usage = self._get_usage_for_period(db, tenant_id, start_date, end_date)
-            
-            # Calculate costs based on plan
-            if subscription.billing_plan.price_per_month == 0:
-                # Free tier
-                return self._calculate_free_tier_cost(db, tenant_id, start_date, end_date, usage)
-            else:
-                # Paid tier
-                return self._calculate_paid_tier_cost(db, tenant_id, subscription, start_date, end_date, usage)
-        
-        except Exception as e:
-            logger.error(f"Error calculating tenant cost: {str(e)}")
-            return {
-                'tenant_id': str(tenant_id),
-                'error': str(e)
-            }
-        finally:
-            db.close()
+            except Exception as e:
+                logger.error(f"Error calculating tenant cost: {str(e)}")
+                return {
+                    'tenant_id': str(tenant_id),
+                    'error': str(e)
+                }
     
     def _get_usage_for_period(
         self,
@@ -84,19 +157,33 @@ class CostCalculator:
         end_date: datetime
     ) -> Dict[str, Any]:
         """Get usage metrics for a period."""
-        # Get aggregated usage records
+        # Get aggregated usage records; storage is also converted to GB in SQL.
+        # Stored storage_gb rows are a truncated copy of storage_bytes, so they
+        # are skipped in favour of the exact conversion.
         usage_records = db.query(
             UsageRecord.metric_name,
-            func.sum(UsageRecord.metric_value).label('total')
+            func.sum(UsageRecord.metric_value).label('total'),
+            func.sum(
+                case(
+                    (
+                        UsageRecord.metric_name == 'storage_bytes',
+                        UsageRecord.metric_value / literal(BYTES_PER_GB)
+                    ),
+                    else_=None
+                )
+            ).label('storage_gb')
         ).filter(
             UsageRecord.tenant_id == tenant_id,
             UsageRecord.recorded_at >= start_date,
-            UsageRecord.recorded_at <= end_date
+            UsageRecord.recorded_at <= end_date,
+            UsageRecord.metric_name != 'storage_gb'
         ).group_by(UsageRecord.metric_name).all()
         
         usage = {}
         for record in usage_records:
             usage[record.metric_name] = record.total
+            if record.storage_gb is not None:
+                usage['storage_gb'] = float(record.storage_gb)
         
         return usage
     
@@ -113,10 +200,7 @@ class CostCalculator:
             usage = self._get_usage_for_period(db, tenant_id, start_date, end_date)
         
         # Get free plan limits
-        free_plan = db.query(BillingPlan).filter(
-            BillingPlan.is_default == True,
-            BillingPlan.price_per_month == 0
-        ).first()
+        free_plan = _PLAN_CACHE.get(FREE_PLAN_KEY) or _load_free_plan(db)
         
         if not free_plan:
             free_plan = BillingPlan(
@@ -127,7 +211,7 @@ class CostCalculator:
             )
         
         # Calculate usage vs limits
-        storage_gb = usage.get('storage_gb', 0) or (usage.get('storage_bytes', 0) / (1024 ** 3))
+        storage_gb = usage.get('storage_gb', 0)
         file_uploads = usage.get('file_uploads', 0)
         
         return {
@@ -170,75 +254,28 @@ class CostCalculator:
         """Calculate costs for paid tier."""
         plan = subscription.billing_plan
         
-        # Calculate base cost
+        # Calculate base cost (Numeric columns are returned as Decimal)
         days_in_period = (end_date - start_date).days
-        monthly_cost = float(plan.price_per_month)
-        daily_cost = monthly_cost / 30  # Simple daily proration
+        daily_cost = plan.price_per_month / DAYS_PER_MONTH  # Simple daily proration
         base_cost = daily_cost * days_in_period
+        proration = Decimal(days_in_period) / DAYS_PER_MONTH
         
-        # Calculate overage costs
-        overage_costs = {}
-        total_overage_cost = 0.00
-        
-        # Storage overage
-        storage_gb = usage.get('storage_gb', 0) or (usage.get('storage_bytes', 0) / (1024 ** 3))
-        if plan.max_storage_gb and storage_gb > plan.max_storage_gb:
-            overage_gb = storage_gb - plan.max_storage_gb
-            storage_overage = overage_gb * config.cost_per_storage_gb * (days_in_period / 30)
-            overage_costs['storage'] = {
-                'overage_gb': overage_gb,
-                'rate_per_gb': config.cost_per_storage_gb,
-                'cost': storage_overage
-            }
-            total_overage_cost += storage_overage
-        
-        # File upload overage
-        file_uploads = usage.get('file_uploads', 0)
-        if plan.max_files_per_month and file_uploads > plan.max_files_per_month:
-            overage_files = file_uploads - plan.max_files_per_month
-            file_overage = overage_files * config.cost_per_file_upload
-            overage_costs['file_uploads'] = {
-                'overage_files': overage_files,
-                'rate_per_file': config.cost_per_file_upload,
-                'cost': file_overage
-            }
-            total_overage_cost += file_overage
-        
-        # API call overage
-        api_calls = usage.get('api_calls', 0)
-        if plan.max_api_calls and api_calls > plan.max_api_calls:
-            overage_calls = api_calls - plan.max_api_calls
-            api_overage = overage_calls * config.cost_per_api_call
-            overage_costs['api_calls'] = {
-                'overage_calls': overage_calls,
-                'rate_per_call': config.cost_per_api_call,
-                'cost': api_overage
-            }
-            total_overage_cost += api_overage
-        
-        # AI token overage
-        ai_tokens = usage.get('ai_tokens_used', 0)
-        # For now, all AI usage is considered overage for simplicity
-        if ai_tokens > 0:
-            ai_cost = ai_tokens * config.cost_per_ai_token
-            overage_costs['ai_tokens'] = {
-                'tokens_used': ai_tokens,
-                'rate_per_token': config.cost_per_ai_token,
-                'cost': ai_cost
+        # Calculate overage costs; a period without usage can only cost the base price
+        if usage:
+            overage_costs, total_overage_cost, usage_percentages = self._calculate_overages(
+                plan, usage, proration
+            )
+        else:
+            overage_costs, total_overage_cost = {}, Decimal(0)
+            usage_percentages = {
+                percentage_key: 0.0
+                for (_, limit_attr, *_, percentage_key) in OVERAGE_SPEC
+                if getattr(plan, limit_attr)
             }
-            total_overage_cost += ai_cost
         
         total_cost = base_cost + total_overage_cost
         
-        # Calculate usage percentages
-        usage_percentages = {}
-        if plan.max_storage_gb:
-            usage_percentages['storage'] = min(100, (storage_gb / plan.max_storage_gb) * 100)
-        if plan.max_files_per_month:
-            usage_percentages['files'] = min(100, (file_uploads / plan.max_files_per_month) * 100)
-        if plan.max_api_calls:
-            usage_percentages['api_calls'] = min(100, (api_calls / plan.max_api_calls) * 100)
-        
+        # Money stays Decimal internally and is converted to float only here
         return {
             'tenant_id': str(tenant_id),
             'subscription_id': str(subscription.id),
@@ -259,86 +296,141 @@ class CostCalculator:
             },
             'usage_percentages': usage_percentages,
             'cost_breakdown': {
-                'base_cost': base_cost,
+                'base_cost': float(base_cost),
                 'overage_costs': overage_costs,
-                'total_overage_cost': total_overage_cost
+                'total_overage_cost': float(total_overage_cost)
             },
-            'total_cost': total_cost,
+            'total_cost': float(total_cost),
             'has_overages': len(overage_costs) > 0,
             'within_limits': total_overage_cost == 0
         }
     
+    def _calculate_overages(
+        self,
+        plan: BillingPlan,
+        usage: Dict[str, Any],
+        proration: Decimal
+    ) -> Tuple[Dict[str, Any], Decimal, Dict[str, float]]:
+        """Calculate overage costs and usage percentages against plan limits."""
+        overage_costs = {}
+        total_overage_cost = Decimal(0)
+        
+        # Limited metrics
+        storage_gb = usage.get('storage_gb', 0)
+        quantities = {
+            'storage_gb': storage_gb,
+            'file_uploads': usage.get('file_uploads', 0),
+            'api_calls': usage.get('api_calls', 0)
+        }
+        
+        usage_percentages = {}
+        for (quantity_key, limit_attr, rate_attr, prorated, cost_key,
+                overage_field, rate_field, percentage_key) in OVERAGE_SPEC:
+            limit = getattr(plan, limit_attr)
+            if not limit:
+                continue
+            
+            quantity = quantities[quantity_key]
+            usage_percentages[percentage_key] = min(100, (quantity / limit) * 100)
+            
+            if quantity > limit:
+                overage = quantity - limit
+                rate = getattr(config, rate_attr)
+                cost = _to_decimal(overage) * _to_decimal(rate)
+                if prorated:
+                    cost *= proration
+                overage_costs[cost_key] = {
+                    overage_field: overage,
+                    rate_field: rate,
+                    'cost': float(cost)
+                }
+                total_overage_cost += cost
+        
+        # AI token overage
+        ai_tokens = usage.get('ai_tokens_used', 0)
+        # For now, all AI usage is considered overage for simplicity
+        if ai_tokens > 0:
+            ai_cost = ai_tokens * _to_decimal(config.cost_per_ai_token)
+            overage_costs['ai_tokens'] = {
+                'tokens_used': ai_tokens,
+                'rate_per_token': config.cost_per_ai_token,
+                'cost': float(ai_cost)
+            }
+            total_overage_cost += ai_cost
+        
+        return overage_costs, total_overage_cost, usage_percentages
+    
+    @query_budget(max_queries=8)
     def forecast_cost(
         self,
         tenant_id: UUID,
         forecast_days: int = 30
     ) -> Dict[str, Any]:
         """Forecast future costs based on current usage patterns."""
-        db: Session = next(get_db())
-        
-        try:
-            # Get current usage for last 30 days
-            end_date = datetime.now()
-            start_date = end_date - timedelta(days=30)
-            
-            current_cost = self.calculate_tenant_cost(tenant_id, start_date, end_date)
-            
-            if 'error' in current_cost:
-                return current_cost
-            
-            # Calculate daily averages
-            usage = current_cost.get('usage', {})
-            days_in_period = 30
-            
-            daily_averages = {}
-            for metric, value in usage.items():
-                daily_averages[metric] = value / days_in_period
-            
-            # Forecast future usage
-            forecasted_usage = {}
-            for metric, daily_avg in daily_averages.items():
-                forecasted_usage[metric] = daily_avg * forecast_days
-            
-            # Get subscription for pricing
-            subscription = db.query(Subscription).filter(
-                Subscription.tenant_id == tenant_id,
-                Subscription.status == 'active'
-            ).first()
-            
-            if subscription:
-                plan = subscription.billing_plan
-                plan_name = plan.name
-                plan_price = float(plan.price_per_month)
-            else:
-                plan_name = 'Free'
-                plan_price = 0.00
-            
-            # Simple forecast calculation
-            # In production, this would be more sophisticated
-            forecasted_cost = {
-                'tenant_id': str(tenant_id),
-                'plan_name': plan_name,
-                'forecast_period_days': forecast_days,
-                'forecast_start': end_date.isoformat(),
-                'forecast_end': (end_date + timedelta(days=forecast_days)).isoformat(),
-                'daily_averages': daily_averages,
-                'forecasted_usage': forecasted_usage,
-                'estimated_monthly_cost': plan_price,
-                'estimated_overage_cost': 0.00,  # Simplified
-                'estimated_total_cost': plan_price,
-                'confidence_score': 0.7  # Medium confidence
-            }
-            
-            return forecasted_cost
-            
-        except Exception as e:
-            logger.error(f"Error forecasting cost: {str(e)}")
-            return {
-                'tenant_id': str(tenant_id),
-                'error': str(e)
-            }
-        finally:
-            db.close()
+        with db_session_scope() as db:
+            try:
+                # Get current usage for last 30 days
+                end_date = datetime.now()
+                start_date = end_date - timedelta(days=30)
+                
+                current_cost = self.calculate_tenant_cost(tenant_id, start_date, end_date)
+                
+                if 'error' in current_cost:
+                    return current_cost
+                
+                # Calculate daily averages
+                usage = current_cost.get('usage', {})
+                days_in_period = 30
+                
+                daily_averages = {}
+                for metric, value in usage.items():
+                    daily_averages[metric] = value / days_in_period
+                
+                # Forecast future usage
+                forecasted_usage = {}
+                for metric, daily_avg in daily_averages.items():
+                    forecasted_usage[metric] = daily_avg * forecast_days
+                
+                # Get subscription for pricing
+                subscription = db.query(Subscription).options(
+                    joinedload(Subscription.billing_plan)
+                ).filter(
+                    Subscription.tenant_id == tenant_id,
+                    Subscription.status == 'active'
+                ).first()
+                
+                if subscription:
+                    plan = subscription.billing_plan
+                    plan_name = plan.name
+                    plan_price = float(plan.price_per_month)
+                else:
+                    plan_name = 'Free'
+                    plan_price = 0.00
+                
+                # Simple forecast calculation
+                # In production, this would be more sophisticated
+                forecasted_cost = {
+                    'tenant_id': str(tenant_id),
+                    'plan_name': plan_name,
+                    'forecast_period_days': forecast_days,
+                    'forecast_start': end_date.isoformat(),
+                    'forecast_end': (end_date + timedelta(days=forecast_days)).isoformat(),
+                    'daily_averages': daily_averages,
+                    'forecasted_usage': forecasted_usage,
+                    'estimated_monthly_cost': plan_price,
+                    'estimated_overage_cost': 0.00,  # Simplified
+                    'estimated_total_cost': plan_price,
+                    'confidence_score': 0.7  # Medium confidence
+                }
+                
+                return forecasted_cost
+                
+            except Exception as e:
+                logger.error(f"Error forecasting cost: {str(e)}")
+                return {
+                    'tenant_id': str(tenant_id),
+                    'error': str(e)
+                }
 
 
 # Global cost calculator instance
@@ -1,17 +1,22 @@
 """
 Usage tracker for monitoring tenant usage metrics.
 """
+import queue
 import threading
 import time
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timedelta
 from typing import Dict, List, Any, Optional
 from uuid import UUID
-from collections import defaultdict
+from collections import defaultdict, deque
 
+from cachetools import TTLCache
 from sqlalchemy.orm import Session
 from sqlalchemy import func, and_
+from sqlalchemy.exc import DBAPIError, OperationalError
 
-from shared.database.session import get_db
+from shared.database.session import db_session_scope
+from shared.database.query_counter import query_budget
 from shared.models.billing_models import UsageRecord
 from shared.models.user_models import Tenant
 from shared.models.file_models import UploadedFile
@@ -20,13 +25,35 @@ from shared.utils.logging import logger
 from services.billing_service.config import config
 
 
+def _is_connection_error(error: Exception) -> bool:
+    """Whether a database error means the write can succeed on retry."""
+    return isinstance(error, OperationalError) or (
+        isinstance(error, DBAPIError) and error.connection_invalidated
+    )
+
+
+def _month_start(now: datetime) -> datetime:
+    """Return the start of the month containing ``now``."""
+    return now.replace(day=1, hour=0, minute=0, second=0, microsecond=0)
+
+
 class UsageTracker:
     """Tracks usage metrics for tenants."""
     
     def __init__(self):
         self.running = False
         self.aggregation_thread = None
-        self.usage_cache = {}  # In-memory cache for quick access
+        self.flush_thread = None
+        # Pending usage events, written to the database in batches
+        self._write_queue: queue.Queue = queue.Queue()
+        # Recent rows the database rejected, kept for inspection
+        self.dead_letters: deque = deque(maxlen=config.usage_dead_letter_size)
+        # Bounded in-memory cache of tenant metrics; entries expire after the TTL
+        self.usage_cache = TTLCache(
+            maxsize=config.usage_cache_max_size,
+            ttl=config.usage_cache_ttl
+        )
+        self._cache_lock = threading.RLock()
         
     def start_background_aggregation(self):
         """Start background usage aggregation."""
@@ -40,6 +67,12 @@ class UsageTracker:
             daemon=True
         )
         self.aggregation_thread.start()
+        
+        self.flush_thread = threading.Thread(
+            target=self._flush_loop,
+            daemon=True
+        )
+        self.flush_thread.start()
         logger.info("Usage aggregation started")
     
     def stop_background_aggregation(self):
@@ -47,6 +80,17 @@ class UsageTracker:
         self.running = False
         if self.aggregation_thread:
             self.aggregation_thread.join(timeout=5)
+        if self.flush_thread:
+            self.flush_thread.join(timeout=5)
+        
+        # Write out anything still queued
+        try:
+            while not self._write_queue.empty():
+                self._flush_usage_writes()
+        except Exception as e:
+            logger.error(
+                f"Could not write {self._write_queue.qsize()} queued usage records on shutdown: {str(e)}"
+            )
         logger.info("Usage aggregation stopped")
     
     def _aggregation_loop(self):
@@ -59,44 +103,161 @@ class UsageTracker:
                 logger.error(f"Error in usage aggregation loop: {str(e)}")
                 time.sleep(60)  # Wait before retrying
     
-    def aggregate_usage_data(self):
-        """Aggregate usage data from various sources."""
-        db: Session = next(get_db())
+    def _flush_loop(self):
+        """Background loop for writing queued usage events."""
+        interval = config.usage_flush_interval_ms / 1000
+        delay = interval
+        backlogged = False
+        while self.running:
+            # Warn once each time the backlog crosses the threshold
+            backlog = self._write_queue.qsize()
+            if backlog >= config.usage_queue_warn_size and not backlogged:
+                logger.warning(f"Usage write queue backlog: {backlog} records pending")
+            backlogged = backlog >= config.usage_queue_warn_size
+            try:
+                self._flush_usage_writes()
+                delay = interval
+            except Exception as e:
+                # Rows hit by a lost connection are requeued; back off while
+                # the database is unreachable
+                delay = min(delay * 2, config.usage_flush_max_backoff)
+                logger.error(f"Error in usage flush loop, retrying in {delay:.1f}s: {str(e)}")
+            time.sleep(delay)
+    
+    def _flush_usage_writes(self) -> int:
+        """
+        Write a batch of queued usage events in one insert.
         
-        try:
-            # Get all active tenants
-            tenants = db.query(Tenant).filter(Tenant.is_active == True).all()
+        If the batch insert fails, the rows are retried one per transaction
+        so a single bad row cannot block the rest. Rows that fail on a lost
+        connection go back on the queue and the error is re-raised so the
+        flush loop backs off; rows the database rejects (integrity or data
+        errors) are logged and dead-lettered.
+        
+        Returns:
+            Number of events written
+        """
+        rows = []
+        while len(rows) < config.usage_write_batch_size:
+            try:
+                rows.append(self._write_queue.get_nowait())
+            except queue.Empty:
+                break
+        
+        if not rows:
+            return 0
+        
+        with db_session_scope() as db:
+            try:
+                db.bulk_insert_mappings(UsageRecord, rows)
+                db.commit()
+                logger.debug(f"Flushed {len(rows)} usage records")
+                return len(rows)
+            except Exception as e:
+                db.rollback()
+                if _is_connection_error(e):
+                    self._requeue(rows)
+                    raise
+                logger.warning(f"Batch usage insert failed, retrying row by row: {str(e)}")
             
-            for tenant in tenants:
-                # Calculate various usage metrics
-                metrics = self._calculate_tenant_metrics(db, tenant.id)
+            written = 0
+            for i, row in enumerate(rows):
+                try:
+                    db.bulk_insert_mappings(UsageRecord, [row])
+                    db.commit()
+                    written += 1
+                except Exception as e:
+                    db.rollback()
+                    if _is_connection_error(e):
+                        self._requeue(rows[i:])
+                        raise
+                    self._dead_letter(row, e)
+            
+            logger.debug(f"Flushed {written} of {len(rows)} usage records individually")
+            return written
+    
+    def _requeue(self, rows: List[Dict[str, Any]]):
+        """Put unwritten usage rows back on the write queue."""
+        for row in rows:
+            self._write_queue.put(row)
+    
+    def _dead_letter(self, row: Dict[str, Any], error: Exception):
+        """Set aside a usage row the database will never accept."""
+        self.dead_letters.append(row)
+        logger.error(
+            f"Dropping usage record the database rejected: {str(error)}",
+            tenant_id=str(row.get('tenant_id')),
+            metric_name=row.get('metric_name'),
+            metric_value=row.get('metric_value'),
+            recorded_at=str(row.get('recorded_at'))
+        )
+    
+    # Tenant list plus the paged bulk insert; the per-tenant queries run on
+    # worker threads and are budgeted in _calculate_tenant_metrics_in_session
+    @query_budget(max_queries=3)
+    def aggregate_usage_data(self):
+        """Aggregate usage data from various sources."""
+        with db_session_scope() as db:
+            try:
+                # Align every tenant's metrics to the same month boundary
+                month_start = _month_start(datetime.now())
                 
-                # Store aggregated metrics
-                self._store_usage_metrics(db, tenant.id, metrics)
+                # Get all active tenant IDs (only the id column is needed)
+                tenant_ids = [
+                    tid for (tid,) in db.query(Tenant.id).filter(Tenant.is_active.is_(True)).all()
+                ]
                 
-                # Update cache
-                self.usage_cache[str(tenant.id)] = {
-                    'metrics': metrics,
-                    'last_updated': datetime.now().isoformat()
-                }
-            
-            logger.info(f"Aggregated usage data for {len(tenants)} tenants")
-            
-        except Exception as e:
-            logger.error(f"Error aggregating usage data: {str(e)}")
-        finally:
-            db.close()
+                # Calculate usage metrics concurrently; each tenant's queries are
+                # independent, so their round trips can overlap
+                tenant_metrics: Dict[UUID, Dict[str, Any]] = {}
+                if tenant_ids:
+                    max_workers = min(config.usage_aggregation_workers, len(tenant_ids))
+                    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+                        tenant_metrics = dict(executor.map(
+                            lambda tid: (tid, self._calculate_tenant_metrics_in_session(tid, month_start)),
+                            tenant_ids
+                        ))
+                
+                # Store aggregated metrics for all tenants in one insert
+                self._store_usage_metrics(db, tenant_metrics)
+                
+                snapshot = {str(tenant_id): metrics for tenant_id, metrics in tenant_metrics.items()}
+                
+                # Publish all tenants at once to keep the lock hold time short
+                with self._cache_lock:
+                    self.usage_cache.update(snapshot)
+                
+                logger.info(f"Aggregated usage data for {len(tenant_ids)} tenants")
+                
+            except Exception as e:
+                logger.error(f"Error aggregating usage data: {str(e)}")
     
-    def _calculate_tenant_metrics(self, db: Session, tenant_id: UUID) -> Dict[str, Any]:
+    @query_budget(max_queries=4)
+    def _calculate_tenant_metrics_in_session(
+        self,
+        tenant_id: UUID,
+        month_start: datetime
+    ) -> Dict[str, Any]:
+        """Calculate usage metrics for a tenant using a dedicated session."""
+        # Sessions are not thread-safe, so every worker opens its own
+        with db_session_scope() as db:
+            return self._calculate_tenant_metrics(db, tenant_id, month_start)
+    
+    def _calculate_tenant_metrics(
+        self,
+        db: Session,
+        tenant_id: UUID,
+        month_start: datetime
+    ) -> Dict[str, Any]:
         """Calculate usage metrics for a tenant."""
         metrics = {
-            'file_uploads': self._count_file_uploads(db, tenant_id),
+            'file_uploads': self._count_file_uploads(db, tenant_id, month_start),
             'storage_bytes': self._calculate_storage_usage(db, tenant_id),
-            'reports_generated': self._count_reports_generated(db, tenant_id),
+            'reports_generated': self._count_reports_generated(db, tenant_id, month_start),
             'api_calls': self._count_api_calls(db, tenant_id),
             'ai_tokens_used': self._estimate_ai_usage(db, tenant_id),
             'active_users': self._count_active_users(db, tenant_id),
-            'current_month_start': datetime.now().replace(day=1, hour=0, minute=0, second=0, microsecond=0)
+            'current_month_start': month_start
         }
         
         # Calculate derived metrics
@@ -104,10 +265,8 @@ class UsageTracker:
         
         return metrics
     
-    def _count_file_uploads(self, db: Session, tenant_id: UUID) -> int:
+    def _count_file_uploads(self, db: Session, tenant_id: UUID, month_start: datetime) -> int:
         """Count file uploads for tenant in current month."""
-        month_start = datetime.now().replace(day=1, hour=0, minute=0, second=0, microsecond=0)
-        
         count = db.query(func.count(UploadedFile.id)).filter(
             UploadedFile.tenant_id == tenant_id,
             UploadedFile.created_at >= month_start,
@@ -127,10 +286,8 @@ class UsageTracker:
         
         return int(total_bytes or 0)
     
-    def _count_reports_generated(self, db: Session, tenant_id: UUID) -> int:
+    def _count_reports_generated(self, db: Session, tenant_id: UUID, month_start: datetime) -> int:
         """Count reports generated for tenant in current month."""
-        month_start = datetime.now().replace(day=1, hour=0, minute=0, second=0, microsecond=0)
-        
         count = db.query(func.count(Report.id)).filter(
             Report.tenant_id == tenant_id,
             Report.created_at >= month_start,
@@ -164,137 +321,191 @@ class UsageTracker:
         
         return count or 0
     
-    def _store_usage_metrics(self, db: Session, tenant_id: UUID, metrics: Dict[str, Any]):
-        """Store usage metrics in database."""
+    def _store_usage_metrics(self, db: Session, tenant_metrics: Dict[UUID, Dict[str, Any]]):
+        """Store usage metrics for multiple tenants in database."""
         recorded_at = datetime.now()
         
-        for metric_name, metric_value in metrics.items():
-            if isinstance(metric_value, (int, float)):
-                # Don't store datetime values
-                if not isinstance(metric_value, datetime):
-                    usage_record = UsageRecord(
-                        tenant_id=tenant_id,
-                        metric_name=metric_name,
-                        metric_value=int(metric_value) if isinstance(metric_value, int) else float(metric_value),
-                        recorded_at=recorded_at
-                    )
-                    db.add(usage_record)
+        rows = []
+        for tenant_id, metrics in tenant_metrics.items():
+            for metric_name, metric_value in metrics.items():
+                if isinstance(metric_value, (int, float)):
+                    # Don't store datetime values
+                    if not isinstance(metric_value, datetime):
+                        rows.append({
+                            'tenant_id': tenant_id,
+                            'metric_name': metric_name,
+                            'metric_value': int(metric_value) if isinstance(metric_value, int) else float(metric_value),
+                            'recorded_at': recorded_at
+                        })
         
-        db.commit()
+        if rows:
+            db.bulk_insert_mappings(UsageRecord, rows)
+            db.commit()
     
-    def get_tenant_usage(self, tenant_id: UUID, timeframe: str = "month") -> Dict[str, Any]:
-        """Get usage data for a tenant."""
-        db: Session = next(get_db())
+    @query_budget(max_queries=3)
+    def get_tenant_usage(
+        self,
+        tenant_id: UUID,
+        timeframe: str = "month",
+        include_history: bool = False
+    ) -> Dict[str, Any]:
+        """
+        Get usage data for a tenant.
         
-        try:
-            # Calculate time range
-            end_date = datetime.now()
-            if timeframe == "day":
-                start_date = end_date - timedelta(days=1)
-            elif timeframe == "week":
-                start_date = end_date - timedelta(weeks=1)
-            elif timeframe == "month":
-                start_date = end_date.replace(day=1)
-            elif timeframe == "year":
-                start_date = end_date.replace(month=1, day=1)
-            else:
-                start_date = end_date - timedelta(days=30)  # Default 30 days
-            
-            # Get usage records
-            usage_records = db.query(UsageRecord).filter(
-                UsageRecord.tenant_id == tenant_id,
-                UsageRecord.recorded_at >= start_date,
-                UsageRecord.recorded_at <= end_date
-            ).order_by(UsageRecord.recorded_at).all()
-            
-            # Group by metric
-            metrics = defaultdict(list)
-            for record in usage_records:
-                metrics[record.metric_name].append({
-                    'value': record.metric_value,
-                    'timestamp': record.recorded_at.isoformat()
-                })
-            
-            # Get current metrics from cache or calculate
-            current_metrics = self.usage_cache.get(str(tenant_id), {}).get('metrics', {})
-            
-            # Calculate totals
-            totals = {}
-            for metric_name, records in metrics.items():
-                if records:
-                    values = [r['value'] for r in records]
-                    totals[metric_name] = {
-                        'total': sum(values),
-                        'average': sum(values) / len(values),
-                        'max': max(values),
-                        'min': min(values)
+        Args:
+            tenant_id: Tenant UUID
+            timeframe: Time window (day, week, month, year)
+            include_history: Also return the per-metric time series
+        
+        Returns:
+            Usage totals and, optionally, historical data
+        """
+        with db_session_scope() as db:
+            try:
+                # Calculate time range
+                end_date = datetime.now()
+                if timeframe == "day":
+                    start_date = end_date - timedelta(days=1)
+                elif timeframe == "week":
+                    start_date = end_date - timedelta(weeks=1)
+                elif timeframe == "month":
+                    start_date = end_date.replace(day=1)
+                elif timeframe == "year":
+                    start_date = end_date.replace(month=1, day=1)
+                else:
+                    start_date = end_date - timedelta(days=30)  # Default 30 days
+                
+                period_filter = (
+                    UsageRecord.tenant_id == tenant_id,
+                    UsageRecord.recorded_at >= start_date,
+                    UsageRecord.recorded_at <= end_date
+                )
+                
+                # Aggregate totals in the database
+                totals_q = db.query(
+                    UsageRecord.metric_name,
+                    func.sum(UsageRecord.metric_value).label('total'),
+                    func.avg(UsageRecord.metric_value).label('average'),
+                    func.max(UsageRecord.metric_value).label('max'),
+                    func.min(UsageRecord.metric_value).label('min'),
+                    func.count(UsageRecord.id).label('count')
+                ).filter(*period_filter).group_by(UsageRecord.metric_name).all()
+                
+                totals = {}
+                for row in totals_q:
+                    totals[row.metric_name] = {
+                        'total': row.total,
+                        'average': float(row.average) if row.average is not None else 0,
+                        'max': row.max,
+                        'min': row.min,
+                        'count': row.count
                     }
-            
-            return {
-                'tenant_id': str(tenant_id),
-                'timeframe': timeframe,
-                'start_date': start_date.isoformat(),
-                'end_date': end_date.isoformat(),
-                'current_metrics': current_metrics,
-                'historical_data': dict(metrics),
-                'totals': totals
-            }
-            
-        except Exception as e:
-            logger.error(f"Error getting tenant usage: {str(e)}")
-            return {
-                'tenant_id': str(tenant_id),
-                'error': str(e)
-            }
-        finally:
-            db.close()
+                
+                # Get current metrics from cache or calculate
+                with self._cache_lock:
+                    current_metrics = self.usage_cache.get(str(tenant_id), {})
+                
+                result = {
+                    'tenant_id': str(tenant_id),
+                    'timeframe': timeframe,
+                    'start_date': start_date.isoformat(),
+                    'end_date': end_date.isoformat(),
+                    'current_metrics': current_metrics,
+                    'totals': totals
+                }
+                
+                if include_history:
+                    # Fetch only the columns needed for the time series
+                    history_rows = db.query(
+                        UsageRecord.metric_name,
+                        UsageRecord.metric_value,
+                        UsageRecord.recorded_at
+                    ).filter(*period_filter).order_by(UsageRecord.recorded_at).all()
+                    
+                    history = defaultdict(list)
+                    for metric_name, metric_value, recorded_at in history_rows:
+                        history[metric_name].append({
+                            'value': metric_value,
+                            'timestamp': recorded_at.isoformat()
+                        })
+                    
+                    result['historical_data'] = dict(history)
+                
+                return result
+                
+            except Exception as e:
+                logger.error(f"Error getting tenant usage: {str(e)}")
+                return {
+                    'tenant_id': str(tenant_id),
+                    'error': str(e)
+                }
     
-    def record_usage(self, tenant_id: UUID, metric_name: str, metric_value: int, context: Optional[Dict] = None):
-        """Record a usage event."""
-        db: Session = next(get_db())
+    def record_usage(
+        self,
+        tenant_id: UUID,
+        metric_name: str,
+        metric_value: int,
+        context: Optional[Dict] = None,
+        flush_sync: bool = False
+    ):
+        """
+        Record a usage event.
         
-        try:
-            usage_record = UsageRecord(
-                tenant_id=tenant_id,
-                metric_name=metric_name,
-                metric_value=metric_value,
-                recorded_at=datetime.now(),
-                context=context
-            )
-            
-            db.add(usage_record)
-            db.commit()
-            
-            logger.debug(f"Recorded usage: {metric_name}={metric_value} for tenant {tenant_id}")
-            
-        except Exception as e:
-            logger.error(f"Error recording usage: {str(e)}")
-            db.rollback()
-        finally:
-            db.close()
+        Events are queued and written in batches by the flush thread.
+        Pass ``flush_sync=True`` to write the event immediately.
+        """
+        # Local time, like the aggregated metrics and the usage queries
+        recorded_at = datetime.now()
+        
+        if not flush_sync:
+            self._write_queue.put({
+                'tenant_id': tenant_id,
+                'metric_name': metric_name,
+                'metric_value': metric_value,
+                'recorded_at': recorded_at,
+                'context': context
+            })
+            return
+        
+        with db_session_scope() as db:
+            try:
+                usage_record = UsageRecord(
+                    tenant_id=tenant_id,
+                    metric_name=metric_name,
+                    metric_value=metric_value,
+                    recorded_at=recorded_at,
+                    context=context
+                )
+                
+                db.add(usage_record)
+                db.commit()
+                
+                logger.debug(f"Recorded usage: {metric_name}={metric_value} for tenant {tenant_id}")
+                
+            except Exception as e:
+                logger.error(f"Error recording usage: {str(e)}")
+                db.rollback()
     
+    @query_budget(max_queries=6)
     def get_usage_summary(self, tenant_id: UUID) -> Dict[str, Any]:
         """Get usage summary for a tenant."""
-        # Try cache first
-        if str(tenant_id) in self.usage_cache:
-            cached_data = self.usage_cache[str(tenant_id)]
-            if datetime.fromisoformat(cached_data['last_updated']) > datetime.now() - timedelta(minutes=5):
-                return cached_data['metrics']
+        # Try cache first (expired entries are evicted by the TTL cache)
+        with self._cache_lock:
+            cached_metrics = self.usage_cache.get(str(tenant_id))
+        if cached_metrics is not None:
+            return cached_metrics
         
         # Calculate fresh metrics
-        db: Session = next(get_db())
-        try:
-            metrics = self._calculate_tenant_metrics(db, tenant_id)
+        with db_session_scope() as db:
+            metrics = self._calculate_tenant_metrics(
+                db, tenant_id, _month_start(datetime.now())
+            )
             
             # Update cache
-            self.usage_cache[str(tenant_id)] = {
-                'metrics': metrics,
-                'last_updated': datetime.now().isoformat()
-            }
+            with self._cache_lock:
+                self.usage_cache[str(tenant_id)] = metrics
             
             return metrics
-        finally:
-            db.close()
 
 
 # Global usage tracker instance
@@ -1,35 +1,99 @@
 """
 Budget management for LLM API usage.
 """
-import json
-from typing import Dict, List, Any, Optional, Tuple
+import itertools
+import mmap
+import os
+import secrets
+import shutil
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+from typing import Dict, Iterator, List, Any, Optional, Tuple
 from datetime import datetime, timedelta
 from pathlib import Path
-import uuid
+
+import orjson
+import zstandard
 
 from shared.utils.logging import logger
 from services.llm_service.config import config
+from services.llm_service.budget.usage_index import UsageIndex, to_naive_utc
+
+# Leading bytes of a zstd frame
+ZSTD_MAGIC = b"\x28\xb5\x2f\xfd"
+
+# Number of per-tenant lock stripes (power of two)
+LOCK_STRIPES = 64
+
+# Indexed by how many thresholds (warning, limit) have been reached
+BUDGET_STATUSES = ("HEALTHY", "WARNING", "EXCEEDED")
 
 
 class BudgetManager:
-    """Manages budgets for LLM API usage."""
+    """
+    Manages budgets for LLM API usage.
+    
+    Durability: updates are appended to the WAL without fsync, so a process
+    crash loses nothing but a power loss may drop the most recent updates.
+    Call ``flush()`` to force logged updates to stable storage. Compacted
+    snapshots are synced before the WAL they replace is discarded.
+    """
     
     def __init__(self):
         self.budgets: Dict[str, Dict[str, Any]] = {}
         self.usage: Dict[str, List[Dict[str, Any]]] = {}
+        self._usage_index = UsageIndex()
+        self._rollups: Dict[str, Dict[str, Any]] = {}
         self.budgets_file = Path("data/budgets.json")
         self.usage_file = Path("data/llm_usage.json")
         
+        # Write-ahead log of budget updates since the last snapshot
+        self.usage_wal_file = Path("data/llm_usage.wal")
+        self._wal_rotated_file = self.usage_wal_file.with_suffix(".wal.old")
+        self._wal_fd: Optional[int] = None
+        self._wal_bytes = 0
+        self._wal_lock = threading.Lock()
+        
+        # Per-tenant state is guarded by striped locks; snapshots take all stripes
+        self._locks = [threading.Lock() for _ in range(LOCK_STRIPES)]
+        
+        # Snapshot writer state; each file's tmp path is written by one thread at a time
+        self._dirty = threading.Event()
+        self._write_locks = {
+            self.budgets_file: threading.Lock(),
+            self.usage_file: threading.Lock()
+        }
+        self._running = False
+        self._writer_thread: Optional[threading.Thread] = None
+        
+        # Thresholds as percentages
+        self._warn_pct = config.cost_warning_threshold * 100
+        self._limit_pct = config.cost_limit_threshold * 100
+        
+        # Usage record ids: per-process random nonce plus a counter
+        self._id_nonce = secrets.token_hex(8)
+        self._id_counter = itertools.count()
+        
+        # "%Y-%m" of the current UTC month, refreshed at most once a second
+        self._month_cache = ""
+        self._month_checked_at = -1
+        
         # Ensure data directory exists
         self.budgets_file.parent.mkdir(parents=True, exist_ok=True)
         self.usage_file.parent.mkdir(parents=True, exist_ok=True)
     
+    def load(self):
+        """Load budgets and usage from the last snapshot and replay the WAL."""
+        self.load_budgets()
+        self.load_usage()
+    
     def load_budgets(self):
         """Load budgets from disk."""
         try:
             if self.budgets_file.exists():
-                with open(self.budgets_file, 'r') as f:
-                    self.budgets = json.load(f)
+                self.budgets = self._read_json(self.budgets_file)
                 logger.info(f"Loaded {len(self.budgets)} budgets")
         except Exception as e:
             logger.error(f"Error loading budgets: {str(e)}")
@@ -38,32 +102,265 @@ class BudgetManager:
     def save_budgets(self):
         """Save budgets to disk."""
         try:
-            with open(self.budgets_file, 'w') as f:
-                json.dump(self.budgets, f, indent=2)
+            with self._all_locks():
+                budgets = self._copy_budgets()
+            self._write_json(self.budgets_file, budgets)
             logger.info("Budgets saved to disk")
         except Exception as e:
             logger.error(f"Error saving budgets: {str(e)}")
     
     def load_usage(self):
-        """Load usage data from disk."""
+        """Load usage data from disk, then replay updates logged since."""
         try:
             if self.usage_file.exists():
-                with open(self.usage_file, 'r') as f:
-                    self.usage = json.load(f)
+                self.usage = self._read_json(self.usage_file)
                 logger.info(f"Loaded usage data for {len(self.usage)} tenants")
         except Exception as e:
             logger.error(f"Error loading usage: {str(e)}")
             self.usage = {}
+        
+        self._replay_wal()
+        self._usage_index.rebuild(self.usage)
+        self._rebuild_rollups()
     
     def save_usage(self):
         """Save usage data to disk."""
         try:
-            with open(self.usage_file, 'w') as f:
-                json.dump(self.usage, f, indent=2)
+            with self._all_locks():
+                usage = {tenant_id: list(records) for tenant_id, records in self.usage.items()}
+            self._write_json(self.usage_file, usage, compress=config.compress_usage_log)
             logger.info("Usage data saved to disk")
         except Exception as e:
             logger.error(f"Error saving usage: {str(e)}")
     
+    def start_background_writer(self):
+        """Start the background snapshot writer."""
+        if self._running:
+            logger.warning("Budget snapshot writer already running")
+            return
+        
+        self._running = True
+        self._writer_thread = threading.Thread(
+            target=self._writer_loop,
+            daemon=True
+        )
+        self._writer_thread.start()
+        logger.info("Budget snapshot writer started")
+    
+    def stop_background_writer(self):
+        """Stop the background snapshot writer and write a final snapshot."""
+        self._running = False
+        if self._writer_thread:
+            self._writer_thread.join(timeout=5)
+        
+        if self._dirty.is_set():
+            self._dirty.clear()
+            self.write_snapshot()
+        logger.info("Budget snapshot writer stopped")
+    
+    def _writer_loop(self):
+        """
+        Background loop that persists budgets and compacts the usage log.
+        
+        Budgets are small and rewritten once per debounce window. The usage
+        snapshot is only rewritten once the WAL grows past
+        ``usage_log_compact_bytes``; until then the WAL is the record.
+        """
+        interval = config.budget_snapshot_interval_ms / 1000
+        while self._running:
+            if not self._dirty.wait(timeout=1):
+                continue
+            
+            # Let further updates accumulate before writing
+            time.sleep(interval)
+            self._dirty.clear()
+            try:
+                if self._wal_bytes >= config.usage_log_compact_bytes:
+                    self.write_snapshot()
+                else:
+                    with self._all_locks():
+                        budgets = self._copy_budgets()
+                    self._write_json(self.budgets_file, budgets)
+            except Exception as e:
+                logger.error(f"Error writing budget snapshot: {str(e)}")
+    
+    def write_snapshot(self):
+        """
+        Write full budget and usage snapshots and discard the replayed WAL.
+        
+        The in-memory state is copied and the WAL rotated while holding every
+        lock stripe; serialization and disk I/O happen outside them. The rotated WAL
+        is only removed once both snapshots are on disk.
+        """
+        with self._all_locks():
+            budgets = self._copy_budgets()
+            usage = {tenant_id: list(records) for tenant_id, records in self.usage.items()}
+            self._rotate_wal()
+        
+        self._write_json(self.budgets_file, budgets, durable=True)
+        self._write_json(self.usage_file, usage, durable=True, compress=config.compress_usage_log)
+        self._wal_rotated_file.unlink(missing_ok=True)
+        logger.debug("Budget snapshot written")
+    
+    def _lock_for(self, tenant_id: str) -> threading.Lock:
+        """Get the lock stripe guarding a tenant's state."""
+        return self._locks[hash(tenant_id) & (LOCK_STRIPES - 1)]
+    
+    @contextmanager
+    def _all_locks(self) -> Iterator[None]:
+        """Hold every lock stripe, acquired in a fixed order."""
+        for lock in self._locks:
+            lock.acquire()
+        try:
+            yield
+        finally:
+            for lock in reversed(self._locks):
+                lock.release()
+    
+    def _copy_budgets(self) -> Dict[str, Dict[str, Any]]:
+        """Copy budgets so they can be serialized without holding the lock."""
+        return {
+            tenant_id: dict(budget, warnings_sent=list(budget["warnings_sent"]))
+            for tenant_id, budget in self.budgets.items()
+        }
+    
+    def _read_json(self, path: Path) -> Any:
+        """
+        Parse a JSON file straight from a read-only memory mapping.
+        
+        zstd-compressed files are recognized by their frame magic, so
+        snapshots load regardless of the current compression setting.
+        """
+        with open(path, 'rb') as f:
+            if os.fstat(f.fileno()).st_size == 0:
+                return {}
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                with memoryview(mm) as view:
+                    if view[:4] == ZSTD_MAGIC:
+                        return orjson.loads(zstandard.ZstdDecompressor().decompress(view))
+                    return orjson.loads(view)
+    
+    def flush(self):
+        """Force updates logged so far to stable storage."""
+        with self._wal_lock:
+            if self._wal_fd is not None:
+                os.fsync(self._wal_fd)
+    
+    def _write_json(self, path: Path, data: Any, durable: bool = False, compress: bool = False):
+        """
+        Atomically replace a JSON file.
+        
+        The payload is serialized up front and handed to the kernel in as
+        few write calls as possible rather than streamed in small chunks.
+        
+        Args:
+            path: Destination file
+            data: JSON-serializable data
+            durable: fsync the new file before it replaces the old one
+            compress: Write a single zstd frame instead of indented JSON
+        """
+        if compress:
+            payload = zstandard.ZstdCompressor(level=3).compress(orjson.dumps(data))
+        else:
+            payload = orjson.dumps(data, option=orjson.OPT_INDENT_2)
+        payload = memoryview(payload)
+        tmp_path = path.with_suffix(path.suffix + ".tmp")
+        with self._write_locks.setdefault(path, threading.Lock()):
+            fd = os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+            try:
+                while payload:
+                    written = os.write(fd, payload)
+                    payload = payload[written:]
+                if durable:
+                    os.fsync(fd)
+            finally:
+                os.close(fd)
+            os.replace(tmp_path, path)
+    
+    def _append_wal(self, usage_record: Dict[str, Any], budget: Dict[str, Any]):
+        """Append one update to the WAL with a single write call."""
+        entry = orjson.dumps({"usage": usage_record, "budget": budget}, option=orjson.OPT_APPEND_NEWLINE)
+        with self._wal_lock:
+            if self._wal_fd is None:
+                self._wal_fd = os.open(
+                    self.usage_wal_file,
+                    os.O_WRONLY | os.O_CREAT | os.O_APPEND,
+                    0o644
+                )
+            self._wal_bytes += os.write(self._wal_fd, entry)
+    
+    def _rotate_wal(self):
+        """Move the current WAL aside so new updates start a fresh log."""
+        with self._wal_lock:
+            if self._wal_fd is not None:
+                os.close(self._wal_fd)
+                self._wal_fd = None
+            self._wal_bytes = 0
+        
+        if not self.usage_wal_file.exists():
+            return
+        
+        if self._wal_rotated_file.exists():
+            # A previous snapshot failed; keep its entries as well
+            with open(self._wal_rotated_file, 'ab') as dst, open(self.usage_wal_file, 'rb') as src:
+                shutil.copyfileobj(src, dst)
+            self.usage_wal_file.unlink()
+        else:
+            os.replace(self.usage_wal_file, self._wal_rotated_file)
+    
+    def _replay_wal(self):
+        """Apply WAL entries that are not yet part of the loaded snapshot."""
+        seen_ids = {
+            tenant_id: {record["id"] for record in records}
+            for tenant_id, records in self.usage.items()
+        }
+        replayed = 0
+        
+        for wal_file in (self._wal_rotated_file, self.usage_wal_file):
+            if not wal_file.exists():
+                continue
+            
+            self._wal_bytes += wal_file.stat().st_size
+            with open(wal_file, 'rb') as f:
+                for line in f:
+                    try:
+                        entry = orjson.loads(line)
+                    except orjson.JSONDecodeError:
+                        # Torn final write from a crash
+                        logger.warning(f"Skipping corrupt WAL entry in {wal_file}")
+                        continue
+                    
+                    usage_record = entry["usage"]
+                    tenant_id = usage_record["tenant_id"]
+                    
+                    # Budgets on disk may already be newer than the entry
+                    budget = self.budgets.get(tenant_id)
+                    if budget is None or entry["budget"]["updated_at"] >= budget["updated_at"]:
+                        self.budgets[tenant_id] = entry["budget"]
+                    
+                    tenant_ids = seen_ids.setdefault(tenant_id, set())
+                    if usage_record["id"] not in tenant_ids:
+                        tenant_ids.add(usage_record["id"])
+                        self.usage.setdefault(tenant_id, []).append(usage_record)
+                        replayed += 1
+        
+        if replayed:
+            logger.info(f"Replayed {replayed} usage records from WAL")
+            self._dirty.set()
+    
+    def _current_month(self) -> str:
+        """
+        Get the current UTC month as "%Y-%m".
+        
+        The formatted value is cached and only recomputed when the wall
+        clock second changes, keeping strftime off the per-request path.
+        """
+        now = int(time.time())
+        if now != self._month_checked_at:
+            self._month_cache = datetime.utcnow().strftime("%Y-%m")
+            self._month_checked_at = now
+        return self._month_cache
+    
     def get_or_create_budget(self, tenant_id: str) -> Dict[str, Any]:
         """
         Get or create budget for tenant.
@@ -74,20 +371,31 @@ class BudgetManager:
         Returns:
             Budget configuration
         """
-        if tenant_id not in self.budgets:
-            self.budgets[tenant_id] = {
+        budget = self.budgets.get(tenant_id)
+        if budget is None:
+            with self._lock_for(tenant_id):
+                budget = self._get_or_create_budget(tenant_id)
+        return budget
+    
+    def _get_or_create_budget(self, tenant_id: str) -> Dict[str, Any]:
+        """Get or create a budget; caller holds the tenant's lock."""
+        budget = self.budgets.get(tenant_id)
+        if budget is None:
+            now = datetime.utcnow().isoformat()
+            budget = {
                 "monthly_budget": config.default_monthly_budget,
-                "current_month": datetime.utcnow().strftime("%Y-%m"),
+                "current_month": self._current_month(),
                 "spent_this_month": 0.0,
                 "total_spent": 0.0,
                 "warnings_sent": [],
                 "limits_enforced": True,
-                "created_at": datetime.utcnow().isoformat(),
-                "updated_at": datetime.utcnow().isoformat()
+                "created_at": now,
+                "updated_at": now
             }
-            self.save_budgets()
+            self.budgets[tenant_id] = budget
+            self._dirty.set()
         
-        return self.budgets[tenant_id]
+        return budget
     
     def update_budget(
         self,
@@ -110,38 +418,48 @@ class BudgetManager:
         Returns:
             Tuple of (success, message)
         """
-        budget = self.get_or_create_budget(tenant_id)
+        with self._lock_for(tenant_id):
+            budget = self._get_or_create_budget(tenant_id)
+            return self._apply_expense(budget, tenant_id, amount, description, user_id, model)
+    
+    def _apply_expense(
+        self,
+        budget: Dict[str, Any],
+        tenant_id: str,
+        amount: float,
+        description: str,
+        user_id: Optional[str],
+        model: Optional[str]
+    ) -> Tuple[bool, str]:
+        """Apply an expense to a budget and log it; caller holds the tenant's lock."""
+        recorded_at = datetime.utcnow()
+        timestamp = recorded_at.isoformat()
         
         # Check if month has changed
-        current_month = datetime.utcnow().strftime("%Y-%m")
+        current_month = self._current_month()
         if budget["current_month"] != current_month:
-            # Reset monthly spending
-            budget["spent_this_month"] = 0.0
-            budget["current_month"] = current_month
-            budget["warnings_sent"] = []
+            self._reset_month(budget, current_month)
         
         # Update spending
         budget["spent_this_month"] += amount
         budget["total_spent"] += amount
-        budget["updated_at"] = datetime.utcnow().isoformat()
-        
-        # Initialize usage tracking if needed
-        if tenant_id not in self.usage:
-            self.usage[tenant_id] = []
+        budget["updated_at"] = timestamp
         
         # Record usage
         usage_record = {
-            "id": str(uuid.uuid4()),
+            "id": f"{self._id_nonce}-{next(self._id_counter):x}",
             "tenant_id": tenant_id,
             "user_id": user_id,
-            "timestamp": datetime.utcnow().isoformat(),
+            "timestamp": timestamp,
             "amount": amount,
             "description": description,
             "model": model,
             "month": current_month
         }
         
-        self.usage[tenant_id].append(usage_record)
+        self.usage.setdefault(tenant_id, []).append(usage_record)
+        self._usage_index.add(tenant_id, recorded_at, amount, model, user_id)
+        self._update_rollup(tenant_id, usage_record)
         
         # Check budget thresholds
         monthly_budget = budget["monthly_budget"]
@@ -151,7 +469,7 @@ class BudgetManager:
         messages = []
         
         # Check warning threshold
-        if percentage >= config.cost_warning_threshold * 100:
+        if percentage >= self._warn_pct:
             warning_msg = f"Budget warning: {percentage:.1f}% of monthly budget used"
             if warning_msg not in budget["warnings_sent"]:
                 messages.append(warning_msg)
@@ -159,14 +477,14 @@ class BudgetManager:
                 logger.warning(warning_msg, tenant_id=tenant_id)
         
         # Check limit threshold
-        if percentage >= config.cost_limit_threshold * 100 and budget["limits_enforced"]:
+        if percentage >= self._limit_pct and budget["limits_enforced"]:
             limit_msg = f"Budget limit reached: {percentage:.1f}% of monthly budget used"
             messages.append(limit_msg)
             logger.warning(limit_msg, tenant_id=tenant_id)
         
-        # Save updates
-        self.save_budgets()
-        self.save_usage()
+        # Log the update; the background writer folds it into the next snapshot
+        self._append_wal(usage_record, budget)
+        self._dirty.set()
         
         success_msg = f"Updated budget: ${amount:.6f} spent, {percentage:.1f}% of budget used"
         return True, success_msg
@@ -188,10 +506,13 @@ class BudgetManager:
         """
         budget = self.get_or_create_budget(tenant_id)
         
-        # Check if month has changed
-        current_month = datetime.utcnow().strftime("%Y-%m")
+        # Fast path is lock-free; only a month rollover takes the tenant's lock
+        current_month = self._current_month()
         if budget["current_month"] != current_month:
-            return True, "New month, budget reset"
+            with self._lock_for(tenant_id):
+                if budget["current_month"] != current_month:
+                    self._reset_month(budget, current_month)
+                    self._dirty.set()
         
         # Check if limits are enforced
         if not budget["limits_enforced"]:
@@ -204,12 +525,20 @@ class BudgetManager:
         projected_percentage = (projected / monthly_budget) * 100 if monthly_budget > 0 else 0
         
         # Check against limit threshold
-        if projected_percentage >= config.cost_limit_threshold * 100:
+        if projected_percentage >= self._limit_pct:
             message = f"Request would exceed budget limit: ${projected:.2f} (${monthly_budget:.2f} budget)"
             return False, message
         
         return True, "Within budget"
     
+    def _reset_month(self, budget: Dict[str, Any], current_month: str):
+        """Start a new month's spending; caller holds the tenant's lock."""
+        # Zero spending before switching the month so lock-free readers
+        # never pair the new month with the previous month's total
+        budget["spent_this_month"] = 0.0
+        budget["warnings_sent"] = []
+        budget["current_month"] = current_month
+    
     def get_budget_summary(self, tenant_id: str) -> Dict[str, Any]:
         """
         Get budget summary for tenant.
@@ -238,15 +567,20 @@ class BudgetManager:
         projected_end = (spent / days_passed) * days_in_month if days_passed > 0 else 0
         projected_percentage = (projected_end / monthly_budget) * 100 if monthly_budget > 0 else 0
         
-        # Get recent usage
+        # Read today's spend and recent usage from the running rollup
+        rollup = self._rollups.get(tenant_id)
+        spent_today = 0.0
         recent_usage = []
-        if tenant_id in self.usage:
-            recent_usage = self.usage[tenant_id][-10:]  # Last 10 records
+        if rollup:
+            if rollup["day"] == today.strftime("%Y-%m-%d"):
+                spent_today = rollup["spent_today"]
+            recent_usage = list(rollup["recent"])
         
         return {
             "tenant_id": tenant_id,
             "monthly_budget": monthly_budget,
             "spent_this_month": spent,
+            "spent_today": spent_today,
             "total_spent": total_spent,
             "percentage_used": percentage,
             "daily_average": daily_average,
@@ -260,14 +594,45 @@ class BudgetManager:
             "current_month": budget["current_month"]
         }
     
+    def _update_rollup(self, tenant_id: str, usage_record: Dict[str, Any]):
+        """Fold a usage record into the tenant's running summary counters."""
+        day = usage_record["timestamp"][:10]
+        rollup = self._rollups.get(tenant_id)
+        if rollup is None:
+            rollup = self._rollups[tenant_id] = {
+                "day": day,
+                "spent_today": 0.0,
+                "recent": deque(maxlen=10)
+            }
+        
+        if rollup["day"] != day:
+            rollup["day"] = day
+            rollup["spent_today"] = 0.0
+        
+        rollup["spent_today"] += usage_record["amount"]
+        rollup["recent"].append(usage_record)
+    
+    def _rebuild_rollups(self):
+        """Recompute rollups from loaded usage; only each tenant's latest day is read."""
+        self._rollups = {}
+        for tenant_id, records in self.usage.items():
+            if not records:
+                continue
+            
+            last_day = records[-1]["timestamp"][:10]
+            start = len(records)
+            while start > 0 and records[start - 1]["timestamp"][:10] == last_day:
+                start -= 1
+            
+            self._rollups[tenant_id] = {
+                "day": last_day,
+                "spent_today": sum(record["amount"] for record in records[start:]),
+                "recent": deque(records[-10:], maxlen=10)
+            }
+    
     def _get_budget_status(self, percentage: float) -> str:
         """Get budget status based on percentage used."""
-        if percentage >= config.cost_limit_threshold * 100:
-            return "EXCEEDED"
-        elif percentage >= config.cost_warning_threshold * 100:
-            return "WARNING"
-        else:
-            return "HEALTHY"
+        return BUDGET_STATUSES[(percentage >= self._warn_pct) + (percentage >= self._limit_pct)]
     
     def set_budget(
         self,
@@ -286,14 +651,19 @@ class BudgetManager:
         Returns:
             Updated budget
         """
-        budget = self.get_or_create_budget(tenant_id)
-        
-        budget["monthly_budget"] = monthly_budget
-        if limits_enforced is not None:
-            budget["limits_enforced"] = limits_enforced
-        budget["updated_at"] = datetime.utcnow().isoformat()
-        
-        self.save_budgets()
+        with self._lock_for(tenant_id):
+            budget = self._get_or_create_budget(tenant_id)
+            
+            budget["monthly_budget"] = monthly_budget
+            if limits_enforced is not None:
+                budget["limits_enforced"] = limits_enforced
+            budget["updated_at"] = datetime.utcnow().isoformat()
+        
+        # The snapshot writer persists the change; without it, write now
+        if self._running:
+            self._dirty.set()
+        else:
+            self.save_budgets()
         
         logger.info(f"Set budget for tenant {tenant_id}: ${monthly_budget}/month")
         
@@ -316,7 +686,7 @@ class BudgetManager:
         Returns:
             Usage report
         """
-        if tenant_id not in self.usage:
+        if tenant_id not in self._usage_index.tenants:
             return {
                 "tenant_id": tenant_id,
                 "total_usage": 0,
@@ -327,70 +697,16 @@ class BudgetManager:
                 "period": f"{start_date} to {end_date}" if start_date and end_date else "all time"
             }
         
-        # Filter usage by date
-        usage_records = self.usage[tenant_id]
-        
-        if start_date or end_date:
-            filtered = []
-            for record in usage_records:
-                record_date = datetime.fromisoformat(record["timestamp"].replace('Z', '+00:00'))
-                
-                if start_date:
-                    start = datetime.fromisoformat(start_date.replace('Z', '+00:00'))
-                    if record_date < start:
-                        continue
-                
-                if end_date:
-                    end = datetime.fromisoformat(end_date.replace('Z', '+00:00'))
-                    if record_date > end:
-                        continue
-                
-                filtered.append(record)
-            usage_records = filtered
-        
-        # Calculate totals
-        total_cost = sum(record["amount"] for record in usage_records)
-        
-        # Group by model
-        usage_by_model = {}
-        for record in usage_records:
-            model = record.get("model", "unknown")
-            if model not in usage_by_model:
-                usage_by_model[model] = {"count": 0, "cost": 0.0}
-            usage_by_model[model]["count"] += 1
-            usage_by_model[model]["cost"] += record["amount"]
-        
-        # Group by user
-        usage_by_user = {}
-        for record in usage_records:
-            user_id = record.get("user_id", "anonymous")
-            if user_id not in usage_by_user:
-                usage_by_user[user_id] = {"count": 0, "cost": 0.0}
-            usage_by_user[user_id]["count"] += 1
-            usage_by_user[user_id]["cost"] += record["amount"]
-        
-        # Daily usage
-        daily_usage = {}
-        for record in usage_records:
-            date = record["timestamp"][:10]  # YYYY-MM-DD
-            if date not in daily_usage:
-                daily_usage[date] = {"count": 0, "cost": 0.0}
-            daily_usage[date]["count"] += 1
-            daily_usage[date]["cost"] += record["amount"]
-        
-        # Convert to list sorted by date
-        daily_usage_list = [
-            {"date": date, "count": data["count"], "cost": data["cost"]}
-            for date, data in sorted(daily_usage.items())
-        ]
+        # Aggregate over the columnar index in a single vectorized pass
+        report = self._usage_index.report(
+            tenant_id,
+            start=to_naive_utc(start_date) if start_date else None,
+            end=to_naive_utc(end_date) if end_date else None
+        )
         
         return {
             "tenant_id": tenant_id,
-            "total_usage": len(usage_records),
-            "total_cost": total_cost,
-            "usage_by_model": usage_by_model,
-            "usage_by_user": usage_by_user,
-            "daily_usage": daily_usage_list,
+            **report,
             "period": f"{start_date} to {end_date}" if start_date and end_date else "all time",
             "report_generated": datetime.utcnow().isoformat()
         }
@@ -0,0 +1,222 @@
+"""
+Columnar index over LLM usage records for fast reporting.
+"""
+import threading
+from typing import Dict, List, Any, Optional, Tuple
+from datetime import datetime, timezone
+
+import numpy as np
+
+from shared.utils.logging import logger
+
+try:
+    import numba
+    NUMBA_AVAILABLE = True
+except ImportError:
+    NUMBA_AVAILABLE = False
+    logger.warning("numba not installed, usage reports will aggregate with NumPy only")
+
+# Below this many records np.bincount beats spinning up the parallel kernel
+PARALLEL_MIN_RECORDS = 100000
+
+
+class CodeBook:
+    """Dictionary-encodes string values (including None) as small integers."""
+    
+    def __init__(self):
+        self.codes: Dict[Optional[str], int] = {}
+        self.values: List[Optional[str]] = []
+        self._lock = threading.Lock()
+    
+    def encode(self, value: Optional[str]) -> int:
+        """Return the code for a value, assigning a new one if needed."""
+        code = self.codes.get(value)
+        if code is None:
+            with self._lock:
+                code = self.codes.get(value)
+                if code is None:
+                    code = len(self.values)
+                    self.values.append(value)
+                    self.codes[value] = code
+        return code
+
+
+class UsageColumns:
+    """
+    Structure-of-arrays view of one tenant's usage records.
+    
+    Arrays are over-allocated and doubled when full so appends are
+    amortized O(1); only the first ``size`` entries are valid.
+    """
+    
+    def __init__(self, capacity: int = 64):
+        self.size = 0
+        self.ts = np.empty(capacity, dtype="datetime64[us]")
+        self.amount = np.empty(capacity, dtype=np.float64)
+        self.model_id = np.empty(capacity, dtype=np.int32)
+        self.user_id = np.empty(capacity, dtype=np.int32)
+    
+    def append(self, ts: datetime, amount: float, model_id: int, user_id: int):
+        """Append a single record."""
+        if self.size == len(self.amount):
+            self._grow(self.size + 1)
+        
+        i = self.size
+        self.ts[i] = np.datetime64(ts, "us")
+        self.amount[i] = amount
+        self.model_id[i] = model_id
+        self.user_id[i] = user_id
+        self.size += 1
+    
+    def view(self) -> Tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray]:
+        """Return views over the valid part of each column."""
+        n = self.size
+        return self.ts[:n], self.amount[:n], self.model_id[:n], self.user_id[:n]
+    
+    def _grow(self, needed: int):
+        """Reallocate all columns with at least ``needed`` capacity."""
+        capacity = max(needed, len(self.amount) * 2)
+        for name in ("ts", "amount", "model_id", "user_id"):
+            old = getattr(self, name)
+            new = np.empty(capacity, dtype=old.dtype)
+            new[:self.size] = old[:self.size]
+            setattr(self, name, new)
+
+
+class UsageIndex:
+    """Per-tenant columnar usage data with shared model/user code books."""
+    
+    def __init__(self):
+        self.tenants: Dict[str, UsageColumns] = {}
+        self.models = CodeBook()
+        self.users = CodeBook()
+    
+    def add(
+        self,
+        tenant_id: str,
+        ts: datetime,
+        amount: float,
+        model: Optional[str],
+        user_id: Optional[str]
+    ):
+        """Add one usage record to a tenant's columns."""
+        columns = self.tenants.get(tenant_id)
+        if columns is None:
+            columns = self.tenants[tenant_id] = UsageColumns()
+        columns.append(ts, amount, self.models.encode(model), self.users.encode(user_id))
+    
+    def rebuild(self, usage: Dict[str, List[Dict[str, Any]]]):
+        """
+        Rebuild the index from the record lists.
+        
+        Args:
+            usage: Usage records keyed by tenant ID
+        """
+        self.tenants = {}
+        self.models = CodeBook()
+        self.users = CodeBook()
+        
+        for tenant_id, records in usage.items():
+            n = len(records)
+            columns = UsageColumns(capacity=max(n, 64))
+            
+            # numpy parses the ISO strings in C; no per-record fromisoformat
+            columns.ts[:n] = np.array([record["timestamp"] for record in records], dtype="datetime64[us]")
+            columns.amount[:n] = [record["amount"] for record in records]
+            columns.model_id[:n] = [self.models.encode(record.get("model")) for record in records]
+            columns.user_id[:n] = [self.users.encode(record.get("user_id")) for record in records]
+            columns.size = n
+            
+            self.tenants[tenant_id] = columns
+    
+    def report(
+        self,
+        tenant_id: str,
+        start: Optional[datetime] = None,
+        end: Optional[datetime] = None
+    ) -> Dict[str, Any]:
+        """
+        Aggregate a tenant's usage within an optional time range.
+        
+        Args:
+            tenant_id: Tenant ID
+            start: Inclusive lower bound (naive UTC)
+            end: Inclusive upper bound (naive UTC)
+        
+        Returns:
+            Totals plus per-model, per-user and per-day count and cost
+        """
+        ts, amount, model_id, user_id = self.tenants[tenant_id].view()
+        
+        if start is not None or end is not None:
+            mask = np.ones(len(ts), dtype=bool)
+            if start is not None:
+                mask &= ts >= np.datetime64(start, "us")
+            if end is not None:
+                mask &= ts <= np.datetime64(end, "us")
+            ts, amount, model_id, user_id = ts[mask], amount[mask], model_id[mask], user_id[mask]
+        
+        days, day_id = np.unique(ts.astype("datetime64[D]"), return_inverse=True)
+        
+        return {
+            "total_usage": len(amount),
+            "total_cost": float(amount.sum()),
+            "usage_by_model": self._group(model_id, amount, self.models.values),
+            "usage_by_user": self._group(user_id, amount, self.users.values),
+            "daily_usage": [
+                {"date": date, "count": data["count"], "cost": data["cost"]}
+                for date, data in self._group(
+                    day_id, amount, np.datetime_as_string(days).tolist()
+                ).items()
+            ]
+        }
+    
+    @staticmethod
+    def _group(
+        ids: np.ndarray,
+        amount: np.ndarray,
+        labels: List[Any]
+    ) -> Dict[Any, Dict[str, Any]]:
+        """Count and sum amounts per code, keyed by label."""
+        if NUMBA_AVAILABLE and len(ids) >= PARALLEL_MIN_RECORDS:
+            counts, costs = _grouped_totals(ids, amount, len(labels), numba.get_num_threads())
+        else:
+            counts = np.bincount(ids, minlength=len(labels))
+            costs = np.bincount(ids, weights=amount, minlength=len(labels))
+        return {
+            labels[code]: {"count": int(counts[code]), "cost": float(costs[code])}
+            for code in np.flatnonzero(counts)
+        }
+
+
+if NUMBA_AVAILABLE:
+    @numba.njit(parallel=True, cache=True)
+    def _grouped_totals(ids, amount, n_groups, n_chunks):
+        """Per-group counts and amount sums, accumulated per chunk in parallel."""
+        counts = np.zeros((n_chunks, n_groups), dtype=np.int64)
+        costs = np.zeros((n_chunks, n_groups), dtype=np.float64)
+        chunk_size = (len(ids) + n_chunks - 1) // n_chunks
+        
+        for chunk in numba.prange(n_chunks):
+            end = min(len(ids), (chunk + 1) * chunk_size)
+            for i in range(chunk * chunk_size, end):
+                counts[chunk, ids[i]] += 1
+                costs[chunk, ids[i]] += amount[i]
+        
+        return counts.sum(axis=0), costs.sum(axis=0)
+
+
+def to_naive_utc(value: str) -> datetime:
+    """
+    Parse an ISO 8601 string into a naive UTC datetime.
+    
+    Args:
+        value: ISO timestamp, optionally with a ``Z`` or offset suffix
+    
+    Returns:
+        Naive datetime in UTC
+    """
+    parsed = datetime.fromisoformat(value.replace('Z', '+00:00'))
+    if parsed.tzinfo is not None:
+        parsed = parsed.astimezone(timezone.utc).replace(tzinfo=None)
+    return parsed
@@ -1,13 +1,18 @@
 """
 Fallback client for when OpenAI is unavailable.
 """
-from typing import Dict, List, Any, Optional
+from typing import Dict, List, Any, Optional, Tuple
+from functools import lru_cache
+import asyncio
+import re
 import time
 import random
 
 from shared.utils.logging import logger
 from services.llm_service.config import config
 
+AMOUNT_PATTERN = re.compile(r'\$\d+[\d,]*\.?\d*')
+
 
 class FallbackClient:
     """Fallback client that provides basic responses when OpenAI is unavailable."""
@@ -38,6 +43,14 @@ class FallbackClient:
         }
         
         self.default_response = "I'm unable to provide a detailed analysis at this time. Please try again later or contact support."
+        
+        # Immutable copies used for selection
+        self._responses = {
+            prompt_type: tuple(responses)
+            for prompt_type, responses in self.responses.items()
+        }
+        self._rng = random.Random()
+        self._count_choices = tuple(map(str, range(1, 11)))
     
     def create_completion(
         self,
@@ -56,6 +69,43 @@ class FallbackClient:
         Returns:
             Fallback response
         """
+        user_message, content = self._generate(messages, prompt_type)
+        
+        if config.fallback_simulate_latency:
+            time.sleep(self._rng.uniform(0.5, 1.5))
+        
+        return self._build_response(user_message, content)
+    
+    async def acreate_completion(
+        self,
+        messages: List[Dict[str, str]],
+        prompt_type: str = None,
+        **kwargs
+    ) -> Dict[str, Any]:
+        """
+        Create a fallback completion without blocking the event loop.
+        
+        Args:
+            messages: List of messages
+            prompt_type: Type of prompt for context-aware response
+            **kwargs: Additional arguments
+        
+        Returns:
+            Fallback response
+        """
+        user_message, content = self._generate(messages, prompt_type)
+        
+        if config.fallback_simulate_latency:
+            await asyncio.sleep(self._rng.uniform(0.5, 1.5))
+        
+        return self._build_response(user_message, content)
+    
+    def _generate(
+        self,
+        messages: List[Dict[str, str]],
+        prompt_type: Optional[str]
+    ) -> Tuple[str, str]:
+        """Pick a canned response for the conversation."""
         # Extract user message
         user_message = ""
         for msg in messages:
@@ -63,28 +113,30 @@ class FallbackClient:
                 user_message = msg.get("content", "")
                 break
         
+        lowered = user_message.lower()
+        
         # Determine response based on prompt type
-        if prompt_type and prompt_type in self.responses:
-            responses = self.responses[prompt_type]
-            content = random.choice(responses)
-        elif "explain" in user_message.lower():
-            content = random.choice(self.responses.get("explain_anomaly", [self.default_response]))
-        elif "summary" in user_message.lower() or "summarize" in user_message.lower():
-            content = random.choice(self.responses.get("summarize_findings", [self.default_response]))
+        if prompt_type and prompt_type in self._responses:
+            content = self._rng.choice(self._responses[prompt_type])
+        elif "explain" in lowered:
+            content = self._rng.choice(self._responses["explain_anomaly"])
+        elif "summary" in lowered or "summarize" in lowered:
+            content = self._rng.choice(self._responses["summarize_findings"])
         else:
             content = self.default_response
         
         # Add context from user message
         if user_message:
             # Extract key values for personalization
-            if "amount" in user_message.lower():
+            if "amount" in lowered:
                 content = content.replace("{amount}", self._extract_amount(user_message))
-            if "count" in user_message.lower():
-                content = content.replace("{count}", str(random.randint(1, 10)))
-        
-        # Simulate some processing time
-        time.sleep(random.uniform(0.5, 1.5))
+            if "count" in lowered:
+                content = content.replace("{count}", self._count_choices[self._rng.randrange(10)])
         
+        return user_message, content
+    
+    def _build_response(self, user_message: str, content: str) -> Dict[str, Any]:
+        """Build the completion response payload."""
         return {
             "success": True,
             "model": "fallback",
@@ -101,7 +153,7 @@ class FallbackClient:
                 "currency": "USD"
             },
             "performance": {
-                "response_time": random.uniform(0.5, 2.0)
+                "response_time": self._rng.uniform(0.5, 2.0)
             },
             "metadata": {
                 "is_fallback": True,
@@ -109,12 +161,13 @@ class FallbackClient:
             }
         }
     
-    def _extract_amount(self, text: str) -> str:
+    @staticmethod
+    @lru_cache(maxsize=1024)
+    def _extract_amount(text: str) -> str:
         """Extract amount from text."""
-        import re
-        amounts = re.findall(r'\$\d+[\d,]*\.?\d*', text)
-        if amounts:
-            return amounts[0]
+        match = AMOUNT_PATTERN.search(text)
+        if match:
+            return match.group(0)
         return "$1,000"  # Default
     
     def get_status(self) -> Dict[str, Any]:
@@ -1,15 +1,107 @@
 """
 OpenAI client with retry logic and fallback mechanisms.
 """
+import asyncio
+import hashlib
+from functools import cached_property, lru_cache
+import threading
+import httpx
 import openai
-from typing import Dict, List, Any, Optional, Tuple
+from typing import AsyncIterator, Dict, List, Any, Optional, Tuple, Union
 import tiktoken
-from tenacity import retry, stop_after_attempt, wait_exponential, retry_if_exception_type
+from cachetools import LRUCache, TTLCache
+import orjson
+from tenacity import (
+    AsyncRetrying,
+    RetryCallState,
+    retry_if_exception_type,
+    stop_after_attempt,
+    wait_random_exponential
+)
 import time
 
 from shared.utils.logging import logger
 from services.llm_service.config import config
-from services.llm_service.budget.cost_tracker import cost_tracker
+from services.llm_service.budget.budget_manager import budget_manager
+
+try:
+    from tokenizers import Tokenizer
+    TOKENIZERS_AVAILABLE = True
+except ImportError:
+    TOKENIZERS_AVAILABLE = False
+
+# Model pricing as (input, output) USD per 1K tokens
+MODEL_PRICING: Dict[str, Tuple[float, float]] = {
+    "gpt-4": (0.03, 0.06),
+    "gpt-4-32k": (0.06, 0.12),
+    "gpt-3.5-turbo": (0.0015, 0.002),
+    "gpt-3.5-turbo-16k": (0.003, 0.004),
+}
+
+# Longer texts are cached under a digest so the cache does not pin them
+TOKEN_CACHE_KEY_MAX_CHARS = 1024
+
+
+# Transient API errors worth retrying
+RETRYABLE_ERRORS = (
+    openai.APIConnectionError,
+    openai.APITimeoutError,
+    openai.RateLimitError
+)
+
+# Jittered backoff so concurrent callers do not retry in lockstep
+_backoff_wait = wait_random_exponential(multiplier=1, max=30)
+
+
+def _retry_after_seconds(error: BaseException) -> Optional[float]:
+    """Read the server's Retry-After hint from a rate limit error, if any."""
+    if not isinstance(error, openai.RateLimitError) or error.response is None:
+        return None
+    
+    headers = error.response.headers
+    try:
+        if "retry-after-ms" in headers:
+            return float(headers["retry-after-ms"]) / 1000
+        if "retry-after" in headers:
+            return float(headers["retry-after"])
+    except ValueError:
+        # HTTP-date form; fall back to backoff
+        return None
+    return None
+
+
+def _retry_wait(retry_state: RetryCallState) -> float:
+    """Wait as long as the server asks, otherwise back off with jitter."""
+    retry_after = _retry_after_seconds(retry_state.outcome.exception())
+    if retry_after is not None:
+        return min(retry_after, 30.0)
+    return _backoff_wait(retry_state)
+
+
+# Shared retry policy; each call iterates a copy since attempts carry state
+_RETRY_POLICY = AsyncRetrying(
+    stop=stop_after_attempt(3),
+    wait=_retry_wait,
+    retry=retry_if_exception_type(RETRYABLE_ERRORS),
+    reraise=True
+)
+
+
+@lru_cache(maxsize=None)
+def get_encoding(model: str) -> tiktoken.Encoding:
+    """
+    Get the tiktoken encoding for a model, loading each BPE table once.
+    
+    Args:
+        model: Model name
+    
+    Returns:
+        Encoding for the model, or cl100k_base if the model is unknown
+    """
+    try:
+        return tiktoken.encoding_for_model(model)
+    except KeyError:
+        return tiktoken.get_encoding("cl100k_base")
 
 
 class OpenAIClient:
@@ -25,31 +117,65 @@ class OpenAIClient:
         self.temperature = config.temperature
         self.timeout = config.timeout
         
+        # Shared HTTP/2 connection pool for all completions
+        self.http_client = httpx.AsyncClient(
+            http2=True,
+            limits=httpx.Limits(
+                max_connections=config.http_max_connections,
+                max_keepalive_connections=config.http_max_keepalive,
+                keepalive_expiry=config.http_keepalive_expiry
+            ),
+            timeout=httpx.Timeout(self.timeout)
+        )
+        
         # Initialize OpenAI client
-        self.client = openai.OpenAI(
+        self.client = openai.AsyncOpenAI(
             api_key=self.api_key,
             organization=self.organization,
             base_url=self.base_url,
-            timeout=self.timeout
+            timeout=self.timeout,
+            http_client=self.http_client
         )
         
-        # Initialize tokenizer for cost estimation
-        try:
-            self.tokenizer = tiktoken.encoding_for_model(self.default_model)
-        except:
-            self.tokenizer = tiktoken.get_encoding("cl100k_base")
-        
-        # Model pricing (per 1K tokens)
-        self.pricing = {
-            "gpt-4": {"input": 0.03, "output": 0.06},
-            "gpt-4-32k": {"input": 0.06, "output": 0.12},
-            "gpt-3.5-turbo": {"input": 0.0015, "output": 0.002},
-            "gpt-3.5-turbo-16k": {"input": 0.003, "output": 0.004},
-        }
+        # Token counts by content, shared by estimate_cost and count_tokens
+        self._token_counts: LRUCache = LRUCache(maxsize=config.token_cache_size)
+        self._token_counts_lock = threading.Lock()
+        
+        # Completed responses for repeatable (low temperature) requests
+        self._response_cache: TTLCache = TTLCache(maxsize=config.cache_max_size, ttl=config.cache_ttl)
+        
+        # Model pricing as (input, output) USD per 1K tokens
+        self.pricing = MODEL_PRICING
         
         self.is_healthy = False
         self.last_health_check = None
         
+    @cached_property
+    def tokenizer(self) -> tiktoken.Encoding:
+        """Tokenizer for cost estimation, loaded on first use."""
+        return get_encoding(self.default_model)
+    
+    @cached_property
+    def rust_tokenizer(self) -> Optional["Tokenizer"]:
+        """
+        Hugging Face tokenizer used for token counts when configured.
+        
+        Returns None, leaving counting to tiktoken, when ``rust_tokenizer``
+        is unset, the ``tokenizers`` package is missing or loading fails.
+        """
+        if not config.rust_tokenizer:
+            return None
+        
+        if not TOKENIZERS_AVAILABLE:
+            logger.warning("tokenizers not installed, counting tokens with tiktoken")
+            return None
+        
+        try:
+            return Tokenizer.from_pretrained(config.rust_tokenizer)
+        except Exception as e:
+            logger.warning(f"Failed to load tokenizer {config.rust_tokenizer}, counting tokens with tiktoken: {str(e)}")
+            return None
+    
     def get_status(self) -> Dict[str, Any]:
         """Get client status."""
         return {
@@ -59,20 +185,11 @@ class OpenAIClient:
             "fallback_model": self.fallback_model
         }
     
-    @retry(
-        stop=stop_after_attempt(3),
-        wait=wait_exponential(multiplier=1, min=2, max=10),
-        retry=retry_if_exception_type((
-            openai.APIConnectionError,
-            openai.APITimeoutError,
-            openai.RateLimitError
-        ))
-    )
-    def check_health(self) -> bool:
+    async def check_health(self) -> bool:
         """Check if OpenAI API is accessible."""
         try:
             # Simple completion to test connectivity
-            response = self.client.chat.completions.create(
+            response = await self.client.chat.completions.create(
                 model=self.fallback_model,  # Use cheaper model for health check
                 messages=[{"role": "user", "content": "Hello"}],
                 max_tokens=5
@@ -101,35 +218,25 @@ class OpenAIClient:
         if model is None:
             model = self.default_model
         
-        if model not in self.pricing:
+        prices = self.pricing.get(model)
+        if prices is None:
             logger.warning(f"Unknown pricing for model: {model}")
             return 0.0
+        input_price, output_price = prices
         
         # Count tokens
-        total_tokens = 0
-        for message in messages:
-            content = message.get("content", "")
-            total_tokens += len(self.tokenizer.encode(content))
+        total_tokens = sum(self._encode_lens([message.get("content", "") for message in messages]))
         
         # Estimate output tokens (assume similar length to input)
         estimated_output_tokens = min(total_tokens * 1.5, self.max_tokens)
         
         # Calculate cost
-        input_cost = (total_tokens / 1000) * self.pricing[model]["input"]
-        output_cost = (estimated_output_tokens / 1000) * self.pricing[model]["output"]
+        input_cost = (total_tokens / 1000) * input_price
+        output_cost = (estimated_output_tokens / 1000) * output_price
         
         return input_cost + output_cost
     
-    @retry(
-        stop=stop_after_attempt(3),
-        wait=wait_exponential(multiplier=1, min=2, max=10),
-        retry=retry_if_exception_type((
-            openai.APIConnectionError,
-            openai.APITimeoutError,
-            openai.RateLimitError
-        ))
-    )
-    def create_completion(
+    async def create_completion(
         self,
         messages: List[Dict[str, str]],
         model: str = None,
@@ -161,27 +268,48 @@ class OpenAIClient:
         if max_tokens is None:
             max_tokens = self.max_tokens
         
+        # Serve repeatable requests from the response cache; hits cost nothing
+        cache_key = None
+        if config.cache_enabled and temperature <= config.cache_max_temperature:
+            cache_key = self._cache_key(messages, model, temperature, max_tokens)
+            cached = self._response_cache.get(cache_key)
+            if cached is not None:
+                logger.info(f"OpenAI completion served from cache: {model}", tenant_id=tenant_id)
+                return {
+                    **cached,
+                    "cost": {"estimated": 0.0, "actual": 0.0, "currency": "USD"},
+                    "performance": {"response_time": 0.0},
+                    "metadata": {
+                        "tenant_id": tenant_id,
+                        "user_id": user_id,
+                        "timestamp": time.time(),
+                        "cache_hit": True
+                    }
+                }
+        
         # Estimate cost before making request
         estimated_cost = self.estimate_cost(messages, model)
         
         # Check budget before proceeding
         if tenant_id:
-            can_proceed, message = cost_tracker.can_make_request(tenant_id, estimated_cost)
+            can_proceed, message = budget_manager.can_make_request(tenant_id, estimated_cost)
             if not can_proceed:
                 raise ValueError(f"Budget exceeded: {message}")
         
         try:
-            # Make API call
-            start_time = time.time()
-            
-            response = self.client.chat.completions.create(
-                model=model,
-                messages=messages,
-                temperature=temperature,
-                max_tokens=max_tokens
-            )
-            
-            end_time = time.time()
+            # Make API call, retrying transient failures without blocking the loop
+            async for attempt in _RETRY_POLICY.copy():
+                with attempt:
+                    start = time.monotonic_ns()
+                    
+                    response = await self.client.chat.completions.create(
+                        model=model,
+                        messages=messages,
+                        temperature=temperature,
+                        max_tokens=max_tokens
+                    )
+                    
+                    response_time = (time.monotonic_ns() - start) / 1e9
             
             # Calculate actual cost
             usage = response.usage
@@ -189,7 +317,7 @@ class OpenAIClient:
             
             # Track cost
             if tenant_id:
-                cost_tracker.track_cost(
+                self._track_cost(
                     tenant_id=tenant_id,
                     user_id=user_id,
                     model=model,
@@ -215,7 +343,7 @@ class OpenAIClient:
                     "currency": "USD"
                 },
                 "performance": {
-                    "response_time": end_time - start_time
+                    "response_time": response_time
                 },
                 "metadata": {
                     "tenant_id": tenant_id,
@@ -230,6 +358,9 @@ class OpenAIClient:
                 tenant_id=tenant_id
             )
             
+            if cache_key is not None:
+                self._response_cache[cache_key] = result
+            
             return result
             
         except openai.RateLimitError as e:
@@ -252,7 +383,152 @@ class OpenAIClient:
             logger.error(f"OpenAI error: {str(e)}", tenant_id=tenant_id)
             raise
     
-    def create_completion_with_fallback(
+    async def stream_completion(
+        self,
+        messages: List[Dict[str, str]],
+        model: str = None,
+        temperature: float = None,
+        max_tokens: int = None,
+        tenant_id: str = None,
+        user_id: str = None
+    ) -> AsyncIterator[str]:
+        """
+        Stream a chat completion as content deltas.
+        
+        The tenant budget is re-checked every ``stream_budget_check_chunks``
+        chunks and the stream is cut off once the running cost would exceed
+        it. The pinned SDK cannot request usage on streams, so the final
+        cost is tracked from the streamed text, tokenized once at the end.
+        
+        Args:
+            messages: List of messages
+            model: Model to use
+            temperature: Temperature for generation
+            max_tokens: Maximum tokens to generate
+            tenant_id: Tenant ID for cost tracking
+            user_id: User ID for cost tracking
+        
+        Yields:
+            Content deltas as they arrive
+        """
+        if model is None:
+            model = self.default_model
+        
+        if temperature is None:
+            temperature = self.temperature
+        
+        if max_tokens is None:
+            max_tokens = self.max_tokens
+        
+        # Check budget before proceeding
+        if tenant_id:
+            can_proceed, message = budget_manager.can_make_request(tenant_id, self.estimate_cost(messages, model))
+            if not can_proceed:
+                raise ValueError(f"Budget exceeded: {message}")
+        
+        input_price, output_price = self.pricing.get(model, (0.0, 0.0))
+        prompt_tokens = sum(self._encode_lens([message.get("content", "") for message in messages]))
+        prompt_cost = (prompt_tokens / 1000) * input_price
+        
+        async for attempt in _RETRY_POLICY.copy():
+            with attempt:
+                response = await self.client.chat.completions.create(
+                    model=model,
+                    messages=messages,
+                    temperature=temperature,
+                    max_tokens=max_tokens,
+                    stream=True
+                )
+        
+        parts: List[str] = []
+        chunks = 0
+        try:
+            async for chunk in response:
+                if not chunk.choices:
+                    continue
+                
+                content = chunk.choices[0].delta.content
+                if not content:
+                    continue
+                
+                parts.append(content)
+                chunks += 1
+                yield content
+                
+                # Each content chunk carries roughly one token
+                if tenant_id and chunks % config.stream_budget_check_chunks == 0:
+                    running_cost = prompt_cost + (chunks / 1000) * output_price
+                    can_proceed, message = budget_manager.can_make_request(tenant_id, running_cost)
+                    if not can_proceed:
+                        logger.warning(f"Stopping stream after {chunks} chunks: {message}", tenant_id=tenant_id)
+                        break
+        finally:
+            await response.response.aclose()
+            
+            # Bill what was generated, including streams cut off early
+            input_tokens = prompt_tokens
+            # Completions are one-off text, so skip the memoized counter
+            output_tokens = len(self.tokenizer.encode("".join(parts))) if parts else 0
+            cost = prompt_cost + (output_tokens / 1000) * output_price
+            
+            if tenant_id:
+                self._track_cost(
+                    tenant_id=tenant_id,
+                    user_id=user_id,
+                    model=model,
+                    input_tokens=input_tokens,
+                    output_tokens=output_tokens,
+                    cost=cost
+                )
+            
+            logger.info(
+                f"OpenAI stream finished: {model}, "
+                f"tokens: {input_tokens + output_tokens}, cost: ${cost:.6f}",
+                tenant_id=tenant_id
+            )
+    
+    async def create_completions_batch(
+        self,
+        batch: List[List[Dict[str, str]]],
+        **kwargs
+    ) -> List[Dict[str, Any]]:
+        """
+        Create several completions concurrently.
+        
+        Identical conversations in the batch share a single request, and at
+        most ``batch_max_concurrency`` requests are in flight at once.
+        
+        Args:
+            batch: One message list per completion
+            **kwargs: Arguments passed to create_completion
+        
+        Returns:
+            Completion responses in batch order; failures are returned as
+            ``{"success": False, "error": ...}`` entries
+        """
+        semaphore = asyncio.Semaphore(config.batch_max_concurrency)
+        
+        async def run(messages: List[Dict[str, str]]) -> Dict[str, Any]:
+            async with semaphore:
+                return await self.create_completion(messages, **kwargs)
+        
+        inflight: Dict[bytes, asyncio.Task] = {}
+        tasks = []
+        for messages in batch:
+            key = orjson.dumps(messages, option=orjson.OPT_SORT_KEYS)
+            task = inflight.get(key)
+            if task is None:
+                task = inflight[key] = asyncio.ensure_future(run(messages))
+            tasks.append(task)
+        
+        results = await asyncio.gather(*tasks, return_exceptions=True)
+        
+        return [
+            {"success": False, "error": str(result)} if isinstance(result, Exception) else result
+            for result in results
+        ]
+    
+    async def create_completion_with_fallback(
         self,
         messages: List[Dict[str, str]],
         primary_model: str = None,
@@ -278,7 +554,7 @@ class OpenAIClient:
         
         try:
             # Try primary model
-            return self.create_completion(messages, model=primary_model, **kwargs)
+            return await self.create_completion(messages, model=primary_model, **kwargs)
             
         except (openai.RateLimitError, openai.APIConnectionError, openai.APITimeoutError) as e:
             logger.warning(
@@ -288,7 +564,7 @@ class OpenAIClient:
             
             # Try fallback model
             try:
-                return self.create_completion(messages, model=fallback_model, **kwargs)
+                return await self.create_completion(messages, model=fallback_model, **kwargs)
             except Exception as fallback_error:
                 logger.error(
                     f"Fallback model also failed: {str(fallback_error)}",
@@ -296,19 +572,141 @@ class OpenAIClient:
                 )
                 raise fallback_error
     
+    @staticmethod
+    def _cache_key(
+        messages: List[Dict[str, str]],
+        model: str,
+        temperature: float,
+        max_tokens: int
+    ) -> str:
+        """Build a response cache key from everything that shapes the output."""
+        payload = orjson.dumps(
+            [messages, model, temperature, max_tokens],
+            option=orjson.OPT_SORT_KEYS
+        )
+        return hashlib.blake2b(payload, digest_size=16).hexdigest()
+    
+    def _track_cost(
+        self,
+        tenant_id: str,
+        user_id: Optional[str],
+        model: str,
+        input_tokens: int,
+        output_tokens: int,
+        cost: float
+    ):
+        """
+        Record a completion's cost against the tenant's budget.
+        
+        Args:
+            tenant_id: Tenant ID
+            user_id: User ID who made the request
+            model: Model used
+            input_tokens: Prompt tokens
+            output_tokens: Completion tokens
+            cost: Cost in USD
+        """
+        _, message = budget_manager.update_budget(
+            tenant_id,
+            cost,
+            description=f"{model} completion: {input_tokens} input, {output_tokens} output tokens",
+            user_id=user_id,
+            model=model
+        )
+        logger.debug(message, tenant_id=tenant_id)
+    
     def _calculate_actual_cost(self, usage, model: str) -> float:
         """Calculate actual cost based on usage."""
-        if model not in self.pricing:
+        prices = self.pricing.get(model)
+        if prices is None:
             return 0.0
+        input_price, output_price = prices
         
-        input_cost = (usage.prompt_tokens / 1000) * self.pricing[model]["input"]
-        output_cost = (usage.completion_tokens / 1000) * self.pricing[model]["output"]
+        input_cost = (usage.prompt_tokens / 1000) * input_price
+        output_cost = (usage.completion_tokens / 1000) * output_price
         
         return input_cost + output_cost
     
+    async def warm_up(self, connections: int = None) -> int:
+        """
+        Open pooled connections ahead of the first completion.
+        
+        Issues lightweight model lookups concurrently so the TCP/TLS
+        handshakes happen at startup rather than on a user request.
+        
+        Args:
+            connections: Number of concurrent warm-up requests
+        
+        Returns:
+            Number of warm-up requests that succeeded
+        """
+        if connections is None:
+            connections = config.http_prewarm_connections
+        
+        results = await asyncio.gather(
+            *(self.client.models.retrieve(self.fallback_model) for _ in range(connections)),
+            return_exceptions=True
+        )
+        warmed = sum(1 for result in results if not isinstance(result, Exception))
+        
+        if warmed < connections:
+            logger.warning(f"OpenAI warm-up: {warmed}/{connections} requests succeeded")
+        else:
+            logger.info(f"OpenAI connection pool warmed with {warmed} requests")
+        
+        return warmed
+    
+    async def close(self):
+        """Close the underlying HTTP connection pool."""
+        await self.http_client.aclose()
+    
     def count_tokens(self, text: str) -> int:
         """Count tokens in text."""
-        return len(self.tokenizer.encode(text))
+        return self._encode_len(text)
+    
+    def _encode_len(self, content: str) -> int:
+        """Count tokens in text, memoized on the content."""
+        return self._encode_lens([content])[0]
+    
+    def _encode_lens(self, contents: List[str]) -> List[int]:
+        """
+        Count tokens in several texts, memoized on the content.
+        
+        Cache misses are tokenized in one batch call, which both tiktoken
+        and the Rust tokenizer spread across native threads.
+        
+        Args:
+            contents: Texts to count
+        
+        Returns:
+            Token count for each text, in order
+        """
+        keys: List[Union[str, bytes]] = [
+            hashlib.blake2b(content.encode(), digest_size=16).digest()
+            if len(content) > TOKEN_CACHE_KEY_MAX_CHARS else content
+            for content in contents
+        ]
+        
+        with self._token_counts_lock:
+            counts = [self._token_counts.get(key) for key in keys]
+        
+        missing = [i for i, count in enumerate(counts) if count is None]
+        if missing:
+            texts = [contents[i] for i in missing]
+            if self.rust_tokenizer is not None:
+                encodings = self.rust_tokenizer.encode_batch(texts, add_special_tokens=False)
+                fresh = [len(encoding.ids) for encoding in encodings]
+            elif len(texts) == 1:
+                fresh = [len(self.tokenizer.encode(texts[0]))]
+            else:
+                fresh = [len(tokens) for tokens in self.tokenizer.encode_batch(texts)]
+            
+            with self._token_counts_lock:
+                for i, count in zip(missing, fresh):
+                    counts[i] = count
+                    self._token_counts[keys[i]] = count
+        
+        return counts
     
     def truncate_to_token_limit(
         self,
@@ -327,13 +725,30 @@ class OpenAIClient:
         Returns:
             Truncated text
         """
-        tokens = self.tokenizer.encode(text)
+        # Every token covers at least one byte, so short texts always fit
+        if len(text) <= max_tokens and len(text.encode()) <= max_tokens:
+            return text
+        
+        tokenizer = get_encoding(model) if model else self.tokenizer
+        
+        # Tokenize a growing prefix so long payloads are never encoded in full.
+        # Prefixes end before a space, where BPE pieces match the full text.
+        window = max(4 * max_tokens, 1)
+        while window < len(text):
+            cut = text.rfind(" ", 0, window)
+            tokens = tokenizer.encode_ordinary(text[:cut if cut > 0 else window])
+            if len(tokens) > max_tokens:
+                return tokenizer.decode(tokens[:max_tokens])
+            window *= 2
+        
+        tokens = tokenizer.encode_ordinary(text)
         if len(tokens) <= max_tokens:
             return text
         
-        truncated_tokens = tokens[:max_tokens]
-        return self.tokenizer.decode(truncated_tokens)
+        return tokenizer.decode(tokens[:max_tokens])
 
 
-# Global OpenAI client instance
-openai_client = OpenAIClient()
\ No newline at end of file
+@lru_cache(maxsize=1)
+def get_openai_client() -> OpenAIClient:
+    """Get the shared OpenAI client, creating it on first use."""
+    return OpenAIClient()
\ No newline at end of file
@@ -41,16 +41,34 @@ class LLMServiceConfig(BaseSettings):
     max_tokens: int = 1000
     temperature: float = 0.7
     timeout: int = 30  # seconds
+    fallback_simulate_latency: bool = False  # Sleep 0.5-1.5s in fallback responses (local testing only)
+    
+    # HTTP connection pool (shared by all OpenAI requests)
+    http_max_connections: int = 200
+    http_max_keepalive: int = 100
+    http_keepalive_expiry: float = 60.0  # seconds
+    http_prewarm_connections: int = 4  # Warm-up requests issued at startup (0 to disable)
+    
+    # Batch explanations
+    batch_max_size: int = 100
+    batch_max_concurrency: int = 32
+    stream_budget_check_chunks: int = 20  # Re-check the budget every N streamed chunks
     
     # Budget and Cost Management
     default_monthly_budget: float = 100.0  # USD
     cost_warning_threshold: float = 0.8  # 80% of budget
     cost_limit_threshold: float = 0.95  # 95% of budget
+    budget_snapshot_interval_ms: int = 1000  # Debounce window for budget snapshots
+    usage_log_compact_bytes: int = 16777216  # Rewrite the usage snapshot once the WAL reaches 16 MB
+    compress_usage_log: bool = False  # Store the usage snapshot as zstd
     
     # Cache settings
     cache_enabled: bool = True
     cache_ttl: int = 86400  # 24 hours in seconds
     cache_max_size: int = 1000
+    cache_max_temperature: float = 0.3  # Only cache completions at or below this temperature
+    token_cache_size: int = 10000  # Memoized token counts per message content
+    rust_tokenizer: Optional[str] = None  # Hugging Face tokenizer for counts, e.g. "Xenova/gpt-4"
     
     # PII Redaction
     pii_redaction_enabled: bool = True
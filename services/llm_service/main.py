@@ -3,6 +3,7 @@
 LLM Service - AI-powered explanations and analysis using Large Language Models.
 """
 from fastapi import FastAPI, HTTPException, status
+from fastapi.responses import ORJSONResponse
 from contextlib import asynccontextmanager
 import time
 
@@ -11,6 +12,7 @@ from shared.database.base import init_db
 from shared.messaging.rabbitmq_client import rabbitmq_client
 from services.llm_service.config import config
 from services.llm_service.budget.budget_manager import budget_manager
+from services.llm_service.routes.explanation_routes import router as explanation_router
 
 
 @asynccontextmanager
@@ -35,11 +37,20 @@ async def lifespan(app: FastAPI):
     
     # Initialize budget manager
     try:
-        budget_manager.load_budgets()
+        budget_manager.load()
+        budget_manager.start_background_writer()
         logger.info("Budget manager initialized")
     except Exception as e:
         logger.error(f"Budget manager initialization failed: {str(e)}")
     
+    # Pre-warm OpenAI connections so the first request skips the handshake
+    if config.openai_api_key and config.http_prewarm_connections > 0:
+        try:
+            from services.llm_service.clients.openai_client import get_openai_client
+            await get_openai_client().warm_up()
+        except Exception as e:
+            logger.error(f"OpenAI connection warm-up failed: {str(e)}")
+    
     yield
     
     # Shutdown
@@ -47,10 +58,18 @@ async def lifespan(app: FastAPI):
     
     # Save budgets
     try:
-        budget_manager.save_budgets()
+        budget_manager.stop_background_writer()
     except Exception as e:
         logger.error(f"Budget save failed: {str(e)}")
     
+    # Close OpenAI connection pool
+    try:
+        from services.llm_service.clients.openai_client import get_openai_client
+        if get_openai_client.cache_info().currsize:
+            await get_openai_client().close()
+    except Exception as e:
+        logger.error(f"OpenAI client shutdown failed: {str(e)}")
+    
     # Disconnect from RabbitMQ
     try:
         rabbitmq_client.disconnect()
@@ -65,22 +84,31 @@ app = FastAPI(
     version=config.api_version,
     docs_url=config.api_docs_url,
     redoc_url=config.api_redoc_url,
+    default_response_class=ORJSONResponse,
     lifespan=lifespan
 )
 
 
+# Include routers
+app.include_router(
+    explanation_router,
+    prefix=config.api_prefix,
+    tags=["Explanations"]
+)
+
+
 # Health check endpoint
 @app.get(config.health_check_path, tags=["Health"])
 async def health_check():
     """Health check endpoint."""
-    from services.llm_service.clients.openai_client import openai_client
+    from services.llm_service.clients.openai_client import get_openai_client
     
     health_status = {
         "status": "healthy",
         "service": config.api_title,
         "version": config.api_version,
         "timestamp": time.time(),
-        "openai_status": openai_client.get_status(),
+        "openai_status": get_openai_client().get_status(),
         "budget_status": budget_manager.get_total_usage()
     }
     
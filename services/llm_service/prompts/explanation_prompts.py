@@ -1,21 +1,90 @@
 """
 Prompt templates for AI explanations.
 """
+import threading
 from typing import Dict, List, Any, Optional
-import json
 from datetime import datetime
+from functools import cached_property
 from string import Template
 
+import orjson
+import tiktoken
+from cachetools import LRUCache
+
 from shared.utils.logging import logger
+from services.llm_service.config import config
+
+DEFAULT_SYSTEM_PROMPT = "You are a helpful AI assistant specialized in audit, compliance, and risk analysis."
+
+# Context dicts may use non-string keys (e.g. rule IDs); json.dumps coerced them too
+JSON_OPTIONS = orjson.OPT_INDENT_2 | orjson.OPT_NON_STR_KEYS
+
+
+class CompiledTemplate:
+    """
+    A string.Template pre-split into literal segments and placeholders.
+    
+    Rendering is equivalent to ``safe_substitute`` but skips the regex scan:
+    placeholders without a value are left in place and ``$$`` becomes ``$``.
+    """
+    
+    def __init__(self, template: Template):
+        literals: List[str] = []
+        fields: List[str] = []
+        placeholders: List[str] = []
+        segment: List[str] = []
+        text = template.template
+        pos = 0
+        
+        for match in template.pattern.finditer(text):
+            segment.append(text[pos:match.start()])
+            pos = match.end()
+            
+            name = match.group("named") or match.group("braced")
+            if name is None:
+                # Escaped "$$" renders as "$"; invalid placeholders stay as-is
+                segment.append("$" if match.group("escaped") is not None else match.group(0))
+                continue
+            
+            literals.append("".join(segment))
+            segment = []
+            fields.append(name)
+            placeholders.append(match.group(0))
+        
+        segment.append(text[pos:])
+        literals.append("".join(segment))
+        
+        self.literals = tuple(literals)
+        self.fields = tuple(fields)
+        self.placeholders = tuple(placeholders)
+    
+    def render(self, values: Dict[str, str]) -> str:
+        """Substitute values into the template."""
+        parts = [self.literals[0]]
+        for field, placeholder, literal in zip(self.fields, self.placeholders, self.literals[1:]):
+            parts.append(values.get(field, placeholder))
+            parts.append(literal)
+        return "".join(parts)
 
 
 class ExplanationPrompts:
     """Prompt templates for generating AI explanations."""
     
     def __init__(self):
+        # Each template keeps its static instructions ahead of the first
+        # variable so identical prompt prefixes can be reused by the
+        # provider's prompt cache
         self.templates = {
             "explain_anomaly": Template("""
-You are an expert compliance analyst. Explain this anomaly finding to an auditor.
+You are an expert compliance analyst. Explain the anomaly finding below to an auditor.
+
+Please provide:
+1. A clear explanation of why this was flagged as an anomaly
+2. The potential risk or compliance issue
+3. Recommended next steps for investigation
+4. Any false positive indicators to consider
+
+Keep the explanation professional, concise, and actionable. Use bullet points where appropriate.
 
 ANOMALY DETAILS:
 - Severity: $severity
@@ -33,18 +102,19 @@ ANOMALY SCORES:
 
 ADDITIONAL CONTEXT:
 $additional_context
-
-Please provide:
-1. A clear explanation of why this was flagged as an anomaly
-2. The potential risk or compliance issue
-3. Recommended next steps for investigation
-4. Any false positive indicators to consider
-
-Keep the explanation professional, concise, and actionable. Use bullet points where appropriate.
             """),
             
             "explain_rule_violation": Template("""
-You are a regulatory compliance expert. Explain this rule violation finding.
+You are a regulatory compliance expert. Explain the rule violation finding below.
+
+Please provide:
+1. Explanation of the violated rule in simple terms
+2. Why this specific data triggered the violation
+3. Regulatory implications (if any)
+4. Recommended corrective actions
+5. Prevention measures for future
+
+Format the response for a compliance report. Be specific about the violation.
 
 RULE VIOLATION DETAILS:
 - Rule: $rule_name
@@ -58,19 +128,20 @@ $violation_data
 
 CONTEXT:
 $context
-
-Please provide:
-1. Explanation of the violated rule in simple terms
-2. Why this specific data triggered the violation
-3. Regulatory implications (if any)
-4. Recommended corrective actions
-5. Prevention measures for future
-
-Format the response for a compliance report. Be specific about the violation.
             """),
             
             "summarize_findings": Template("""
-You are an audit report writer. Summarize these audit findings for executive review.
+You are an audit report writer. Summarize the audit findings below for executive review.
+
+Please provide:
+1. Executive summary (2-3 sentences)
+2. Key risk areas identified
+3. Most critical findings
+4. Overall risk assessment
+5. Immediate action items
+6. Long-term recommendations
+
+Write in professional business language suitable for C-level executives.
 
 AUDIT SUMMARY:
 - Total Findings: $total_findings
@@ -86,20 +157,20 @@ CONTEXT:
 - Audit Scope: $audit_scope
 - Time Period: $time_period
 - Data Source: $data_source
-
-Please provide:
-1. Executive summary (2-3 sentences)
-2. Key risk areas identified
-3. Most critical findings
-4. Overall risk assessment
-5. Immediate action items
-6. Long-term recommendations
-
-Write in professional business language suitable for C-level executives.
             """),
             
             "suggest_remediation": Template("""
-You are a risk remediation specialist. Suggest actions to address these findings.
+You are a risk remediation specialist. Suggest actions to address the finding below.
+
+Please provide:
+1. Immediate remediation actions (within 24 hours)
+2. Short-term fixes (within 7 days)
+3. Long-term preventive measures
+4. Control enhancements needed
+5. Monitoring requirements post-remediation
+6. Estimated effort and resources
+
+Prioritize actions based on risk and business impact.
 
 FINDING DETAILS:
 - Type: $finding_type
@@ -111,28 +182,10 @@ CONTEXT:
 - Business Impact: $business_impact
 - Regulatory Requirements: $regulatory_requirements
 - Current Controls: $current_controls
-
-Please provide:
-1. Immediate remediation actions (within 24 hours)
-2. Short-term fixes (within 7 days)
-3. Long-term preventive measures
-4. Control enhancements needed
-5. Monitoring requirements post-remediation
-6. Estimated effort and resources
-
-Prioritize actions based on risk and business impact.
             """),
             
             "translate_technical": Template("""
-You are a technical translator. Explain this technical finding in business terms.
-
-TECHNICAL FINDING:
-$technical_finding
-
-BUSINESS CONTEXT:
-- Department: $department
-- Process: $process
-- Business Impact: $business_impact
+You are a technical translator. Explain the technical finding below in business terms.
 
 Please translate this finding by:
 1. Explaining what happened in simple business language
@@ -142,8 +195,46 @@ Please translate this finding by:
 5. Suggesting business-focused next steps
 
 Avoid technical jargon. Focus on business outcomes and risks.
+
+TECHNICAL FINDING:
+$technical_finding
+
+BUSINESS CONTEXT:
+- Department: $department
+- Process: $process
+- Business Impact: $business_impact
             """)
         }
+        
+        self._compiled = {
+            prompt_type: CompiledTemplate(template)
+            for prompt_type, template in self.templates.items()
+        }
+        
+        # Variable values repeat across requests (severities, rule names, ...)
+        self._value_tokens: LRUCache = LRUCache(maxsize=config.token_cache_size)
+        self._value_tokens_lock = threading.Lock()
+    
+    @cached_property
+    def tokenizer(self) -> tiktoken.Encoding:
+        """Tokenizer for estimates, loaded on first use."""
+        try:
+            return tiktoken.encoding_for_model(config.default_model)
+        except KeyError:
+            return tiktoken.get_encoding("cl100k_base")
+    
+    @cached_property
+    def _system_prompt_tokens(self) -> int:
+        """Token count of the default system prompt."""
+        return len(self.tokenizer.encode(DEFAULT_SYSTEM_PROMPT))
+    
+    @cached_property
+    def _template_skeleton_tokens(self) -> Dict[str, int]:
+        """Token counts of each template with its placeholders removed."""
+        return {
+            prompt_type: len(self.tokenizer.encode("".join(compiled.literals)))
+            for prompt_type, compiled in self._compiled.items()
+        }
     
     def get_prompt(
         self,
@@ -166,16 +257,10 @@ Avoid technical jargon. Focus on business outcomes and risks.
             raise ValueError(f"Unknown prompt type: {prompt_type}")
         
         # Format variables for string substitution
-        formatted_vars = {}
-        for key, value in variables.items():
-            if isinstance(value, (dict, list)):
-                formatted_vars[key] = json.dumps(value, indent=2, default=str)
-            else:
-                formatted_vars[key] = str(value)
+        formatted_vars = self._format_variables(variables)
         
-        # Get template and substitute variables
-        template = self.templates[prompt_type]
-        user_prompt = template.safe_substitute(formatted_vars)
+        # Substitute variables into the pre-split template
+        user_prompt = self._compiled[prompt_type].render(formatted_vars)
         
         # Create messages
         messages = []
@@ -184,7 +269,7 @@ Avoid technical jargon. Focus on business outcomes and risks.
         if system_prompt:
             messages.append({"role": "system", "content": system_prompt})
         else:
-            messages.append({"role": "system", "content": "You are a helpful AI assistant specialized in audit, compliance, and risk analysis."})
+            messages.append({"role": "system", "content": DEFAULT_SYSTEM_PROMPT})
         
         # User message
         messages.append({"role": "user", "content": user_prompt})
@@ -209,12 +294,7 @@ Avoid technical jargon. Focus on business outcomes and risks.
             List of messages
         """
         # Format variables
-        formatted_vars = {}
-        for key, value in variables.items():
-            if isinstance(value, (dict, list)):
-                formatted_vars[key] = json.dumps(value, indent=2, default=str)
-            else:
-                formatted_vars[key] = str(value)
+        formatted_vars = self._format_variables(variables)
         
         # Substitute variables
         user_prompt = Template(template).safe_substitute(formatted_vars)
@@ -233,6 +313,9 @@ Avoid technical jargon. Focus on business outcomes and risks.
         """
         Estimate tokens for a prompt.
         
+        Static template text and the default system prompt are counted once
+        at startup; only the substituted values are tokenized per call.
+        
         Args:
             prompt_type: Type of prompt
             variables: Variables
@@ -240,11 +323,39 @@ Avoid technical jargon. Focus on business outcomes and risks.
         Returns:
             Estimated token count
         """
-        messages = self.get_prompt(prompt_type, variables)
+        if prompt_type not in self.templates:
+            raise ValueError(f"Unknown prompt type: {prompt_type}")
+        
+        formatted_vars = self._format_variables(variables)
+        compiled = self._compiled[prompt_type]
         
-        # Simple estimation: 4 characters ≈ 1 token
-        total_chars = sum(len(msg["content"]) for msg in messages)
-        return total_chars // 4
+        # Unfilled placeholders stay in the prompt as "$name"
+        variable_tokens = sum(
+            self._count_tokens(formatted_vars.get(field, placeholder))
+            for field, placeholder in zip(compiled.fields, compiled.placeholders)
+        )
+        
+        return self._system_prompt_tokens + self._template_skeleton_tokens[prompt_type] + variable_tokens
+    
+    def _count_tokens(self, text: str) -> int:
+        """Count tokens in a substituted value, memoized on the text."""
+        with self._value_tokens_lock:
+            count = self._value_tokens.get(text)
+        if count is None:
+            count = len(self.tokenizer.encode(text))
+            with self._value_tokens_lock:
+                self._value_tokens[text] = count
+        return count
+    
+    def _format_variables(self, variables: Dict[str, Any]) -> Dict[str, str]:
+        """Format variable values as strings for template substitution."""
+        formatted_vars = {}
+        for key, value in variables.items():
+            if isinstance(value, (dict, list)):
+                formatted_vars[key] = orjson.dumps(value, default=str, option=JSON_OPTIONS).decode()
+            else:
+                formatted_vars[key] = str(value)
+        return formatted_vars
     
     def get_available_prompts(self) -> Dict[str, str]:
         """Get list of available prompt types with descriptions."""
@@ -2,13 +2,48 @@
 PII (Personally Identifiable Information) redaction for prompts.
 """
 import re
-from typing import Dict, List, Any, Optional, Tuple
+from collections import defaultdict, deque
+from functools import lru_cache
+from typing import Dict, List, Any, Optional, Pattern, Set, Tuple
 import json
+import time
 from datetime import datetime
 
 from shared.utils.logging import logger
 from services.llm_service.config import config
 
+try:
+    import re2
+    RE2_AVAILABLE = True
+except ImportError:
+    RE2_AVAILABLE = False
+    logger.warning("google-re2 not installed, PII redaction will use the re module")
+
+# Every built-in pattern needs an "@", a digit or a capitalized word pair;
+# strings without any of them are skipped. Extend this with new patterns.
+MAYBE_PII = re.compile(r'[@\d]|[A-Z][a-z]+\s[A-Z]')
+
+DEFAULT_SENSITIVE_FIELDS = ("password", "secret", "token", "key", "auth")
+
+# Luhn digit doubling with the "subtract 9" folded in
+LUHN_DOUBLED = (0, 2, 4, 6, 8, 1, 3, 5, 7, 9)
+CARD_SEPARATORS = str.maketrans("", "", " -")
+
+
+def _luhn_valid(number: str) -> bool:
+    """Check a card number (digits with optional spaces/dashes) against the Luhn checksum."""
+    digits = number.translate(CARD_SEPARATORS)
+    total = sum(map(int, digits[-1::-2])) + sum(LUHN_DOUBLED[int(d)] for d in digits[-2::-2])
+    return total % 10 == 0
+
+
+@lru_cache(maxsize=32)
+def _sensitive_field_matcher(sensitive_fields: Tuple[str, ...]) -> Optional[Pattern]:
+    """Compile one case-insensitive matcher for any of the field name fragments."""
+    if not sensitive_fields:
+        return None
+    return re.compile("|".join(map(re.escape, sensitive_fields)), re.IGNORECASE)
+
 
 class PIIRedactor:
     """Redacts PII from text before sending to LLM."""
@@ -19,9 +54,9 @@ class PIIRedactor:
         
         # Regex patterns for different PII types
         self.patterns = {
-            "EMAIL_ADDRESS": r'\b[A-Za-z0-9._%+-]+@[A-Za-z0-9.-]+\.[A-Z|a-z]{2,}\b',
-            "PHONE_NUMBER": r'\b(?:\+\d{1,2}\s?)?\(?\d{3}\)?[\s.-]?\d{3}[\s.-]?\d{4}\b',
-            "CREDIT_CARD": r'\b(?:\d[ -]*?){13,16}\b',
+            "EMAIL_ADDRESS": r'\b[A-Za-z0-9._%+-]+@[A-Za-z0-9.-]+\.[A-Za-z]{2,}\b',
+            "PHONE_NUMBER": r'(?:\+\d{1,2}\s?\(?|\(|\b)\d{3}\)?[\s.-]?\d{3}[\s.-]?\d{4}\b',
+            "CREDIT_CARD": r'\b\d(?:[ -]?\d){12,15}\b',
             "SSN": r'\b\d{3}-\d{2}-\d{4}\b',
             "IP_ADDRESS": r'\b(?:\d{1,3}\.){3}\d{1,3}\b',
         }
@@ -43,6 +78,21 @@ class PIIRedactor:
             "LOCATION": "[ADDRESS_REDACTED]"
         }
         
+        # Compiled pattern and replacement per entity, built once. The
+        # patterns spell out both letter cases, so no case folding is needed.
+        self._entity_spec: Dict[str, Tuple[Pattern, str]] = {}
+        for entity, pattern in {**self.custom_patterns, **self.patterns}.items():
+            self._entity_spec[entity] = (
+                re.compile(pattern),
+                self.replacements.get(entity, f"[{entity}_REDACTED]")
+            )
+        
+        # Combined single-pass patterns keyed by the ordered entity selection
+        self._combined: Dict[Tuple[str, ...], Optional[Pattern]] = {}
+        
+        # (epoch second, ISO string) for report timestamps
+        self._report_timestamp: Tuple[int, str] = (0, "")
+        
     def redact_text(self, text: str, entity_types: List[str] = None) -> Tuple[str, Dict[str, List[str]]]:
         """
         Redact PII from text.
@@ -60,40 +110,84 @@ class PIIRedactor:
         if entity_types is None:
             entity_types = self.entities
         
-        redacted_text = text
-        detected_entities = {}
-        
-        # Check each entity type
-        for entity in entity_types:
-            if entity in self.patterns:
-                pattern = self.patterns[entity]
-                replacement = self.replacements.get(entity, f"[{entity}_REDACTED]")
-                
-                # Find all matches
-                matches = re.findall(pattern, redacted_text, re.IGNORECASE)
-                if matches:
-                    detected_entities[entity] = list(set(matches))
-                
-                # Replace with redaction
-                redacted_text = re.sub(pattern, replacement, redacted_text, flags=re.IGNORECASE)
-            
-            elif entity in self.custom_patterns:
-                pattern = self.custom_patterns[entity]
-                replacement = self.replacements.get(entity, f"[{entity}_REDACTED]")
-                
-                # Find all matches
-                matches = re.findall(pattern, redacted_text)
-                if matches:
-                    detected_entities[entity] = list(set(matches))
-                
-                # Replace with redaction
-                redacted_text = re.sub(pattern, replacement, redacted_text)
+        entity_types = tuple(entity_types)
+        if self._combined_for(entity_types) is None:
+            return text, {}
+        
+        detected_entities: Dict[str, Set[str]] = defaultdict(set)
+        redacted_text = self._redact_with(entity_types, text, detected_entities)
         
         # Log redaction if entities were detected
         if detected_entities:
             logger.info(f"Redacted PII from text: {list(detected_entities.keys())}")
         
-        return redacted_text, detected_entities
+        return redacted_text, {entity: list(matches) for entity, matches in detected_entities.items()}
+    
+    def _redact_with(self, entity_types: Tuple[str, ...], text: str, detected: Dict[str, Set[str]]) -> str:
+        """
+        Replace every match of the entities' combined pattern in one scan.
+        
+        Args:
+            entity_types: Entity types in priority order
+            text: Text to redact
+            detected: Matches per entity type, updated in place
+        
+        Returns:
+            Redacted text
+        """
+        pattern = self._combined_for(entity_types)
+        if pattern is None:
+            return text
+        
+        def replace(match):
+            entity = match.lastgroup
+            value = match.group()
+            # Long digit runs that fail the checksum are not card numbers, but
+            # the card match hid them from the other entities; rescan without it
+            if entity == "CREDIT_CARD" and not _luhn_valid(value):
+                return self._redact_with(
+                    tuple(e for e in entity_types if e != "CREDIT_CARD"), value, detected
+                )
+            detected[entity].add(value)
+            return self._entity_spec[entity][1]
+        
+        return pattern.sub(replace, text)
+    
+    def _combined_for(self, entity_types: Tuple[str, ...]) -> Optional[Pattern]:
+        """
+        Get the alternation of the given entities' patterns, one named group each.
+        
+        Earlier entities take priority where several match at the same
+        position. RE2 is used when available since it scans in linear time
+        without backtracking; patterns it cannot compile fall back to re.
+        
+        Args:
+            entity_types: Entity types in priority order
+        
+        Returns:
+            Compiled pattern, or None if no entity type is known
+        """
+        pattern = self._combined.get(entity_types)
+        if pattern is None and entity_types not in self._combined:
+            groups = []
+            for entity in dict.fromkeys(entity_types):
+                spec = self._entity_spec.get(entity)
+                if spec is not None:
+                    groups.append(f"(?P<{entity}>{spec[0].pattern})")
+            
+            pattern = self._compile("|".join(groups)) if groups else None
+            self._combined[entity_types] = pattern
+        return pattern
+    
+    @staticmethod
+    def _compile(source: str) -> Pattern:
+        """Compile a pattern with RE2 if possible, otherwise with re."""
+        if RE2_AVAILABLE:
+            try:
+                return re2.compile(source)
+            except re2.error as e:
+                logger.warning(f"PII pattern not supported by RE2, using re: {str(e)}")
+        return re.compile(source)
     
     def redact_json(self, data: Any, entity_types: List[str] = None) -> Tuple[Any, Dict[str, List[str]]]:
         """
@@ -112,33 +206,33 @@ class PIIRedactor:
         if entity_types is None:
             entity_types = self.entities
         
-        all_detected = {}
-        
-        def process_value(value):
-            nonlocal all_detected
-            
-            if isinstance(value, str):
-                redacted, detected = self.redact_text(value, entity_types)
-                if detected:
-                    for entity, matches in detected.items():
-                        if entity not in all_detected:
-                            all_detected[entity] = []
-                        all_detected[entity].extend(matches)
-                return redacted
-            elif isinstance(value, dict):
-                return {k: process_value(v) for k, v in value.items()}
-            elif isinstance(value, list):
-                return [process_value(item) for item in value]
-            else:
-                return value
+        entity_types = tuple(entity_types)
+        if self._combined_for(entity_types) is None:
+            return data, {}
         
-        redacted_data = process_value(data)
+        all_detected: Dict[str, Set[str]] = defaultdict(set)
+        
+        # Walk a copy of the structure iteratively, rewriting string leaves
+        root = [data]
+        pending = deque([root])
+        while pending:
+            container = pending.pop()
+            for key, value in (container.items() if isinstance(container, dict) else enumerate(container)):
+                if isinstance(value, str):
+                    if not MAYBE_PII.search(value):
+                        continue
+                    container[key] = self._redact_with(entity_types, value, all_detected)
+                elif isinstance(value, dict):
+                    container[key] = value = dict(value)
+                    pending.append(value)
+                elif isinstance(value, list):
+                    container[key] = value = list(value)
+                    pending.append(value)
         
-        # Deduplicate detected entities
-        for entity in all_detected:
-            all_detected[entity] = list(set(all_detected[entity]))
+        if all_detected:
+            logger.info(f"Redacted PII from JSON: {list(all_detected.keys())}")
         
-        return redacted_data, all_detected
+        return root[0], {entity: list(matches) for entity, matches in all_detected.items()}
     
     def redact_prompt(
         self,
@@ -158,34 +252,32 @@ class PIIRedactor:
         if not self.enabled:
             return messages, {}
         
+        if entity_types is None:
+            entity_types = self.entities
+        
+        entity_types = tuple(entity_types)
+        if self._combined_for(entity_types) is None:
+            return messages, {}
+        
         redacted_messages = []
-        all_detected = {}
+        all_detected: Dict[str, Set[str]] = defaultdict(set)
         
         for message in messages:
             content = message.get("content", "")
             role = message.get("role", "user")
             
             if content:
-                redacted_content, detected = self.redact_text(content, entity_types)
-                
-                # Merge detected entities
-                for entity, matches in detected.items():
-                    if entity not in all_detected:
-                        all_detected[entity] = []
-                    all_detected[entity].extend(matches)
-                
                 redacted_messages.append({
                     "role": role,
-                    "content": redacted_content
+                    "content": self._redact_with(entity_types, content, all_detected)
                 })
             else:
                 redacted_messages.append(message)
         
-        # Deduplicate detected entities
-        for entity in all_detected:
-            all_detected[entity] = list(set(all_detected[entity]))
+        if all_detected:
+            logger.info(f"Redacted PII from prompt: {list(all_detected.keys())}")
         
-        return redacted_messages, all_detected
+        return redacted_messages, {entity: list(matches) for entity, matches in all_detected.items()}
     
     def mask_sensitive_data(
         self,
@@ -203,28 +295,29 @@ class PIIRedactor:
             Masked data
         """
         if sensitive_fields is None:
-            sensitive_fields = ["password", "secret", "token", "key", "auth"]
+            sensitive_fields = DEFAULT_SENSITIVE_FIELDS
+        
+        matcher = _sensitive_field_matcher(tuple(sensitive_fields))
         
         def mask_value(value):
             if isinstance(value, str) and len(value) > 0:
                 return "***" + value[-4:] if len(value) > 4 else "***"
             return "***"
         
+        def process_value(value):
+            if isinstance(value, dict):
+                return process_dict(value)
+            if isinstance(value, list):
+                return [process_value(item) for item in value]
+            return value
+        
         def process_dict(d):
             result = {}
             for key, value in d.items():
-                key_lower = key.lower()
-                is_sensitive = any(sensitive in key_lower for sensitive in sensitive_fields)
-                
-                if is_sensitive:
+                if matcher is not None and matcher.search(str(key)):
                     result[key] = mask_value(value)
-                elif isinstance(value, dict):
-                    result[key] = process_dict(value)
-                elif isinstance(value, list):
-                    result[key] = [process_dict(item) if isinstance(item, dict) else 
-                                  (mask_value(item) if is_sensitive else item) for item in value]
                 else:
-                    result[key] = value
+                    result[key] = process_value(value)
             return result
         
         return process_dict(data)
@@ -239,7 +332,7 @@ class PIIRedactor:
         Returns:
             Redaction report
         """
-        total_entities = sum(len(matches) for matches in detected_entities.values())
+        total_entities = sum(map(len, detected_entities.values()))
         
         return {
             "total_entities_redacted": total_entities,
@@ -251,9 +344,19 @@ class PIIRedactor:
                 }
                 for entity, matches in detected_entities.items()
             },
-            "timestamp": datetime.utcnow().isoformat()
+            "timestamp": self._timestamp()
         }
 
+    
+    def _timestamp(self) -> str:
+        """Current UTC time as ISO 8601, formatted at most once per second."""
+        second = int(time.time())
+        cached_second, formatted = self._report_timestamp
+        if second != cached_second:
+            formatted = datetime.utcfromtimestamp(second).isoformat()
+            self._report_timestamp = (second, formatted)
+        return formatted
+
 
 # Global PII redactor instance
 pii_redactor = PIIRedactor()
\ No newline at end of file
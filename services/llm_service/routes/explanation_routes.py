@@ -0,0 +1,107 @@
+from typing import List, Dict, Any, Optional
+from fastapi import APIRouter, Depends, HTTPException, status, Body
+from fastapi.responses import StreamingResponse
+
+from shared.utils.logging import logger
+
+from services.api_gateway.dependencies.auth import get_current_user_with_tenant
+from services.llm_service.config import config
+from services.llm_service.prompts.explanation_prompts import explanation_prompts
+
+# Create router
+router = APIRouter()
+
+
+@router.post("/explanations/batch")
+async def create_explanations_batch(
+    prompt_type: str = Body(..., description="Prompt template to use"),
+    items: List[Dict[str, Any]] = Body(..., description="Template variables, one entry per explanation"),
+    model: Optional[str] = Body(None, description="Model override"),
+    user_info: tuple = Depends(get_current_user_with_tenant)
+):
+    """
+    Generate explanations for several findings concurrently.
+    """
+    from services.llm_service.clients.openai_client import get_openai_client
+    
+    user_id, tenant_id = user_info
+    
+    if len(items) > config.batch_max_size:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail=f"Batch size exceeds maximum of {config.batch_max_size}"
+        )
+    
+    try:
+        batch = [explanation_prompts.get_prompt(prompt_type, variables) for variables in items]
+    except ValueError as e:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail=str(e)
+        )
+    
+    results = await get_openai_client().create_completions_batch(
+        batch,
+        model=model,
+        tenant_id=str(tenant_id),
+        user_id=str(user_id)
+    )
+    
+    failed = sum(1 for result in results if not result["success"])
+    if failed:
+        logger.warning(f"Explanation batch completed with {failed}/{len(results)} failures", tenant_id=str(tenant_id))
+    
+    return {
+        "prompt_type": prompt_type,
+        "count": len(results),
+        "failed": failed,
+        "results": results
+    }
+
+
+@router.post("/explanations/stream")
+async def stream_explanation(
+    prompt_type: str = Body(..., description="Prompt template to use"),
+    variables: Dict[str, Any] = Body(..., description="Template variables"),
+    model: Optional[str] = Body(None, description="Model override"),
+    user_info: tuple = Depends(get_current_user_with_tenant)
+):
+    """
+    Stream an explanation as plain text while it is generated.
+    """
+    from services.llm_service.clients.openai_client import get_openai_client
+    
+    user_id, tenant_id = user_info
+    
+    try:
+        messages = explanation_prompts.get_prompt(prompt_type, variables)
+    except ValueError as e:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail=str(e)
+        )
+    
+    stream = get_openai_client().stream_completion(
+        messages,
+        model=model,
+        tenant_id=str(tenant_id),
+        user_id=str(user_id)
+    )
+    
+    # Pull the first chunk here so budget and API errors surface as HTTP errors
+    try:
+        first_chunk = await stream.__anext__()
+    except StopAsyncIteration:
+        first_chunk = ""
+    except ValueError as e:
+        raise HTTPException(
+            status_code=status.HTTP_402_PAYMENT_REQUIRED,
+            detail=str(e)
+        )
+    
+    async def body():
+        yield first_chunk
+        async for chunk in stream:
+            yield chunk
+    
+    return StreamingResponse(body(), media_type="text/plain; charset=utf-8")
@@ -10,6 +10,14 @@ from sklearn.preprocessing import StandardScaler, OneHotEncoder
 from sklearn.impute import SimpleImputer
 
 from shared.utils.logging import logger
+from services.ml_service.config import config
+
+try:
+    import numba
+    NUMBA_AVAILABLE = True
+except ImportError:
+    NUMBA_AVAILABLE = False
+    logger.warning("numba not installed, features will be transformed with scikit-learn only")
 
 
 class FeatureExtractor:
@@ -19,9 +27,11 @@ class FeatureExtractor:
         self.numerical_features: List[str] = []
         self.categorical_features: List[str] = []
         self.datetime_features: List[str] = []
+        self.selected_features: Optional[List[str]] = None
+        self._encoded_feature_names: Optional[List[str]] = None  # Set when the encoder is fitted
         self.feature_config: Dict[str, Any] = {}
         self.scaler = StandardScaler()
-        self.encoder = OneHotEncoder(sparse_output=False, handle_unknown='ignore')
+        self.encoder = OneHotEncoder(sparse_output=False, dtype=np.float32, handle_unknown='ignore')
         self.imputer = SimpleImputer(strategy='median')
         
     def analyze_data(self, df: pd.DataFrame) -> Dict[str, Any]:
@@ -42,45 +52,52 @@ class FeatureExtractor:
             "data_types": {}
         }
         
-        for column in df.columns:
-            # Determine data type
-            dtype = str(df[column].dtype)
+        # Column metadata and null counts for the whole frame at once
+        dtypes = df.dtypes.astype(str)
+        missing = df.isna().sum()
+        missing_pct = missing / len(df) * 100
+        
+        numerical: List[str] = []
+        categorical: List[str] = []
+        for column, dtype in dtypes.items():
             analysis["data_types"][column] = dtype
-            
-            # Count missing values
-            missing = df[column].isnull().sum()
-            missing_pct = missing / len(df) * 100
             analysis["missing_values"][column] = {
-                "count": int(missing),
-                "percentage": float(missing_pct)
+                "count": int(missing[column]),
+                "percentage": float(missing_pct[column])
             }
             
             # Determine feature type
             if dtype.startswith('datetime'):
                 self.datetime_features.append(column)
-                feature_type = "datetime"
             elif dtype in ['object', 'category', 'bool']:
-                self.categorical_features.append(column)
-                feature_type = "categorical"
-                # Get unique values
-                unique_count = df[column].nunique()
+                categorical.append(column)
+            else:
+                numerical.append(column)
+        
+        self.categorical_features.extend(categorical)
+        self.numerical_features.extend(numerical)
+        
+        if categorical:
+            unique_counts = df[categorical].nunique()
+            for column in categorical:
                 analysis["feature_types"][column] = {
-                    "type": feature_type,
-                    "unique_values": int(unique_count)
+                    "type": "categorical",
+                    "unique_values": int(unique_counts[column])
+                }
+        
+        # Statistics only for columns that are not entirely missing
+        described = [column for column in numerical if missing[column] < len(df)]
+        if described:
+            stats = df[described].describe().T
+            for column, row in stats.iterrows():
+                analysis["feature_types"][column] = {
+                    "type": "numerical",
+                    "min": float(row["min"]),
+                    "max": float(row["max"]),
+                    "mean": float(row["mean"]),
+                    "std": float(row["std"]),
+                    "median": float(row["50%"])
                 }
-            else:
-                self.numerical_features.append(column)
-                feature_type = "numerical"
-                # Get statistics
-                if missing < len(df):  # Only if not all missing
-                    analysis["feature_types"][column] = {
-                        "type": feature_type,
-                        "min": float(df[column].min()),
-                        "max": float(df[column].max()),
-                        "mean": float(df[column].mean()),
-                        "std": float(df[column].std()),
-                        "median": float(df[column].median())
-                    }
         
         # Store configuration
         self.feature_config = {
@@ -106,18 +123,21 @@ class FeatureExtractor:
         Returns:
             Tuple of (feature_matrix, feature_names)
         """
-        # Make a copy to avoid modifying original
-        df_processed = df.copy()
+        # Datetime parts are collected separately so the input is never copied
+        datetime_parts: Dict[str, np.ndarray] = {}
         
         # Handle datetime features
         for col in self.datetime_features:
-            if col in df_processed.columns:
+            if col in df.columns:
+                # Parse once; unparseable values become NaT and are imputed later
+                dt = pd.to_datetime(df[col], errors='coerce', cache=True)
+                
                 # Extract useful datetime features
-                df_processed[f"{col}_year"] = pd.to_datetime(df_processed[col]).dt.year
-                df_processed[f"{col}_month"] = pd.to_datetime(df_processed[col]).dt.month
-                df_processed[f"{col}_day"] = pd.to_datetime(df_processed[col]).dt.day
-                df_processed[f"{col}_dayofweek"] = pd.to_datetime(df_processed[col]).dt.dayofweek
-                df_processed[f"{col}_hour"] = pd.to_datetime(df_processed[col]).dt.hour
+                datetime_parts[f"{col}_year"] = dt.dt.year.to_numpy(dtype=np.float32)
+                datetime_parts[f"{col}_month"] = dt.dt.month.to_numpy(dtype=np.float32)
+                datetime_parts[f"{col}_day"] = dt.dt.day.to_numpy(dtype=np.float32)
+                datetime_parts[f"{col}_dayofweek"] = dt.dt.dayofweek.to_numpy(dtype=np.float32)
+                datetime_parts[f"{col}_hour"] = dt.dt.hour.to_numpy(dtype=np.float32)
                 
                 # Add to numerical features
                 self.numerical_features.extend([
@@ -125,36 +145,42 @@ class FeatureExtractor:
                     f"{col}_dayofweek", f"{col}_hour"
                 ])
         
-        # Process numerical features
-        numerical_data = df_processed[self.numerical_features].copy()
-        
-        # Handle missing values
-        numerical_data = pd.DataFrame(
-            self.imputer.fit_transform(numerical_data) if training else self.imputer.transform(numerical_data),
-            columns=self.numerical_features
-        )
+        # Process numerical features as a float32 matrix
+        numerical_data = np.column_stack([
+            datetime_parts[name] if name in datetime_parts else df[name].to_numpy(dtype=np.float32, na_value=np.nan)
+            for name in self.numerical_features
+        ]) if self.numerical_features else np.empty((len(df), 0), dtype=np.float32)
         
-        # Scale numerical features
+        # Handle missing values and scale numerical features
         if training:
-            numerical_scaled = self.scaler.fit_transform(numerical_data)
+            numerical_data = self.imputer.fit_transform(numerical_data)
+            numerical_scaled = self.scaler.fit_transform(numerical_data).astype(np.float32, copy=False)
+        elif NUMBA_AVAILABLE and self._can_fuse_transform(numerical_data.shape[1]):
+            numerical_scaled = _impute_and_scale(
+                np.ascontiguousarray(numerical_data),
+                self.imputer.statistics_,
+                self.scaler.mean_,
+                self.scaler.scale_
+            )
         else:
-            numerical_scaled = self.scaler.transform(numerical_data)
+            numerical_data = self.imputer.transform(numerical_data)
+            numerical_scaled = self.scaler.transform(numerical_data).astype(np.float32, copy=False)
         
         # Process categorical features
         categorical_features = []
         if self.categorical_features:
-            categorical_data = df_processed[self.categorical_features].copy()
-            
-            # Fill missing categorical values
-            categorical_data = categorical_data.fillna('MISSING')
+            # Fill missing categorical values (fillna returns a new frame)
+            categorical_data = df[self.categorical_features].fillna('MISSING')
             
             # Encode categorical features
             if training:
                 encoded = self.encoder.fit_transform(categorical_data)
-                categorical_features = self.encoder.get_feature_names_out(self.categorical_features).tolist()
+                self._encoded_feature_names = self.encoder.get_feature_names_out(self.categorical_features).tolist()
             else:
                 encoded = self.encoder.transform(categorical_data)
-                categorical_features = self.encoder.get_feature_names_out(self.categorical_features).tolist()
+                if self._encoded_feature_names is None:
+                    self._encoded_feature_names = self.encoder.get_feature_names_out(self.categorical_features).tolist()
+            categorical_features = self._encoded_feature_names
         else:
             encoded = np.array([])
         
@@ -166,16 +192,58 @@ class FeatureExtractor:
             features = numerical_scaled
             all_feature_names = self.numerical_features
         
-        # Limit features if too many
-        if len(all_feature_names) > 50:  # Adjust as needed
-            logger.warning(f"Too many features ({len(all_feature_names)}), limiting to 50")
-            features = features[:, :50]
-            all_feature_names = all_feature_names[:50]
+        # Limit features if too many, keeping the highest-variance columns seen in training
+        if training:
+            self.selected_features = None
+            if len(all_feature_names) > config.max_features:
+                logger.warning(
+                    f"Too many features ({len(all_feature_names)}), "
+                    f"keeping the {config.max_features} with the highest variance"
+                )
+                # Rank on unstandardized data: after scaling every numerical
+                # column has unit variance. The scaler already holds the
+                # imputed columns' variances. A stable sort breaks ties by
+                # column order, so earlier columns win.
+                variances = self.scaler.var_
+                if encoded.size > 0:
+                    variances = np.concatenate([variances, encoded.var(axis=0)])
+                order = np.argsort(-variances, kind='stable')
+                keep = np.sort(order[:config.max_features])
+                self.selected_features = [all_feature_names[i] for i in keep]
+        
+        if self.selected_features is not None:
+            positions = {name: i for i, name in enumerate(all_feature_names)}
+            keep = [positions[name] for name in self.selected_features if name in positions]
+            features = np.ascontiguousarray(features[:, keep])
+            all_feature_names = [all_feature_names[i] for i in keep]
         
         logger.info(f"Extracted {features.shape[1]} features from {len(df)} records")
         
         return features, all_feature_names
     
+    def _can_fuse_transform(self, n_columns: int) -> bool:
+        """
+        Check whether the fitted imputer and scaler can be applied in one kernel.
+        
+        The imputer drops columns that were entirely missing at fit time, in
+        which case its output no longer lines up column-for-column. The
+        kernel does no bounds checking, so the input must also have exactly
+        as many columns as were fitted; otherwise the sklearn path raises.
+        
+        Args:
+            n_columns: Number of numerical columns to transform
+        """
+        statistics = getattr(self.imputer, "statistics_", None)
+        mean = getattr(self.scaler, "mean_", None)
+        scale = getattr(self.scaler, "scale_", None)
+        return (
+            statistics is not None
+            and mean is not None
+            and scale is not None
+            and n_columns == len(statistics) == len(mean) == len(scale)
+            and not np.isnan(statistics).any()
+        )
+    
     def create_derived_features(self, df: pd.DataFrame) -> pd.DataFrame:
         """
         Create derived features for anomaly detection.
@@ -186,40 +254,56 @@ class FeatureExtractor:
         Returns:
             Dataframe with derived features
         """
-        df_derived = df.copy()
-        
-        # Create statistical features for numerical columns
-        for col in self.numerical_features:
-            if col in df_derived.columns:
-                # Rolling statistics
-                if len(df_derived) > 10:
-                    df_derived[f"{col}_rolling_mean_5"] = df_derived[col].rolling(5, min_periods=1).mean()
-                    df_derived[f"{col}_rolling_std_5"] = df_derived[col].rolling(5, min_periods=1).std()
-                
-                # Percent change
-                df_derived[f"{col}_pct_change"] = df_derived[col].pct_change().fillna(0)
-                
-                # Z-score (within this dataset)
-                mean = df_derived[col].mean()
-                std = df_derived[col].std()
-                if std > 0:
-                    df_derived[f"{col}_zscore"] = (df_derived[col] - mean) / std
-        
-        # Create interaction features
-        if len(self.numerical_features) >= 2:
-            for i, col1 in enumerate(self.numerical_features[:3]):
-                for col2 in self.numerical_features[i+1:4]:
-                    if col1 in df_derived.columns and col2 in df_derived.columns:
-                        df_derived[f"{col1}_times_{col2}"] = df_derived[col1] * df_derived[col2]
-                        df_derived[f"{col1}_div_{col2}"] = df_derived[col1] / (df_derived[col2].replace(0, 1))
+        # New columns are collected and joined once instead of copying df
+        derived: Dict[str, Any] = {}
+        
+        # Create statistical features for numerical columns, one pass per statistic
+        numerical = [col for col in dict.fromkeys(self.numerical_features) if col in df.columns]
+        if numerical:
+            block = df[numerical]
+            
+            # Rolling statistics
+            rolling_window = len(df) > 10
+            if rolling_window:
+                rolling = block.rolling(5, min_periods=1)
+                rolling_means = rolling.mean()
+                rolling_stds = rolling.std()
+            
+            # Percent change
+            pct_changes = block.pct_change().fillna(0)
+            
+            # Z-score (within this dataset); constant columns score 0
+            stds = block.std()
+            zscores = (block - block.mean()) / stds.where(stds > 0, 1.0)
+            
+            for col in numerical:
+                if rolling_window:
+                    derived[f"{col}_rolling_mean_5"] = rolling_means[col]
+                    derived[f"{col}_rolling_std_5"] = rolling_stds[col]
+                derived[f"{col}_pct_change"] = pct_changes[col]
+                derived[f"{col}_zscore"] = zscores[col]
+        
+        # Create interaction features for every pair among the first four columns
+        interacting = [col for col in self.numerical_features[:4] if col in df.columns]
+        if len(interacting) >= 2:
+            values = df[interacting].to_numpy(dtype=np.float64, na_value=np.nan)
+            left, right = np.triu_indices(len(interacting), k=1)
+            divisors = values[:, right]
+            products = values[:, left] * divisors
+            ratios = values[:, left] / np.where(divisors == 0, 1, divisors)
+            
+            for k, (i, j) in enumerate(zip(left, right)):
+                col1, col2 = interacting[i], interacting[j]
+                derived[f"{col1}_times_{col2}"] = products[:, k]
+                derived[f"{col1}_div_{col2}"] = ratios[:, k]
         
         # Create frequency features for categorical columns
         for col in self.categorical_features:
-            if col in df_derived.columns:
-                freq = df_derived[col].value_counts(normalize=True)
-                df_derived[f"{col}_frequency"] = df_derived[col].map(freq).fillna(0)
+            if col in df.columns:
+                freq = df[col].value_counts(normalize=True)
+                derived[f"{col}_frequency"] = df[col].map(freq).fillna(0)
         
-        return df_derived
+        return pd.concat([df, pd.DataFrame(derived, index=df.index)], axis=1, copy=False)
     
     def get_feature_importance(self, model, feature_names: List[str]) -> Dict[str, float]:
         """
@@ -260,6 +344,7 @@ class FeatureExtractor:
             "numerical_features": self.numerical_features,
             "categorical_features": self.categorical_features,
             "datetime_features": self.datetime_features,
+            "selected_features": self.selected_features,
             "scaler_params": {
                 "mean": self.scaler.mean_.tolist() if hasattr(self.scaler, 'mean_') else [],
                 "scale": self.scaler.scale_.tolist() if hasattr(self.scaler, 'scale_') else []
@@ -281,6 +366,7 @@ class FeatureExtractor:
             self.numerical_features = config.get("numerical_features", [])
             self.categorical_features = config.get("categorical_features", [])
             self.datetime_features = config.get("datetime_features", [])
+            self.selected_features = config.get("selected_features")
             
             # Load scaler parameters if available
             if "scaler_params" in config:
@@ -294,4 +380,20 @@ class FeatureExtractor:
             
         except Exception as e:
             logger.error(f"Error loading feature configuration: {str(e)}")
-            return False
\ No newline at end of file
+            return False
+
+
+if NUMBA_AVAILABLE:
+    @numba.njit(parallel=True, cache=True)
+    def _impute_and_scale(values, medians, means, scales):
+        """Median-fill missing values and standardize, touching each element once."""
+        out = np.empty(values.shape, dtype=np.float32)
+        
+        for i in numba.prange(values.shape[0]):
+            for j in range(values.shape[1]):
+                value = values[i, j]
+                if np.isnan(value):
+                    value = medians[j]
+                out[i, j] = (value - means[j]) / scales[j]
+        
+        return out
\ No newline at end of file
@@ -3,17 +3,23 @@ Isolation Forest implementation for anomaly detection.
 """
 import numpy as np
 import pandas as pd
+from scipy.special import expit
 from sklearn.ensemble import IsolationForest
 from sklearn.preprocessing import StandardScaler
 from typing import Dict, List, Any, Tuple, Optional
+import os
 import pickle
+import threading
 import joblib
 from pathlib import Path
-import json
+import orjson
 
 from shared.utils.logging import logger
 from services.ml_service.config import config
 
+# Metadata and comparison files may hold NumPy scalars and arrays
+JSON_OPTIONS = orjson.OPT_INDENT_2 | orjson.OPT_SERIALIZE_NUMPY
+
 
 class IsolationForestAnomalyDetector:
     """Isolation Forest based anomaly detector."""
@@ -26,6 +32,12 @@ class IsolationForestAnomalyDetector:
         self.is_trained: bool = False
         self.metadata: Dict[str, Any] = {}
         
+        # Per-thread (1, n_features) input row reused by predict_single
+        self._row_buffers = threading.local()
+        
+        # (mean_, scale_, float32 mean, float32 1/scale) of the current scaler
+        self._scaling_cache: Optional[Tuple[np.ndarray, ...]] = None
+        
         # Model parameters
         self.contamination = config.isolation_forest_contamination
         self.n_estimators = config.isolation_forest_n_estimators
@@ -41,7 +53,7 @@ class IsolationForestAnomalyDetector:
             n_estimators=self.n_estimators,
             max_samples=self.max_samples,
             random_state=self.random_state,
-            n_jobs=-1
+            n_jobs=config.n_jobs
         )
         
         self.metadata = {
@@ -76,19 +88,27 @@ class IsolationForestAnomalyDetector:
         
         logger.info(f"Training Isolation Forest on {len(X)} samples")
         
-        # Scale features
+        # The forest works in float32 internally; convert once up front
+        X = np.ascontiguousarray(X, dtype=np.float32)
+        
+        # Scale features, keeping the fitted statistics in float32 as well
         X_scaled = self.scaler.fit_transform(X)
+        self.scaler.mean_ = self.scaler.mean_.astype(np.float32)
+        self.scaler.scale_ = self.scaler.scale_.astype(np.float32)
+        self.scaler.var_ = self.scaler.var_.astype(np.float32)
         
-        # Train model
-        self.model.fit(X_scaled)
+        # Train model. Process workers avoid GIL contention in the Python
+        # parts of tree building; loky memory-maps large arrays for them
+        # instead of pickling a copy into each worker
+        with joblib.parallel_config(backend=config.forest_backend, n_jobs=config.n_jobs):
+            self.model.fit(X_scaled)
         
-        # Calculate training metrics
-        predictions = self.model.predict(X_scaled)
+        # Calculate training metrics from a single scoring pass
         anomaly_scores = self.model.score_samples(X_scaled)
         
-        # Convert predictions: 1 = normal, -1 = anomaly
-        anomalies = np.sum(predictions == -1)
-        anomaly_percentage = anomalies / len(predictions) * 100
+        # Anomalies score below the fitted offset
+        anomalies = np.sum(anomaly_scores < self.model.offset_)
+        anomaly_percentage = anomalies / len(anomaly_scores) * 100
         
         # Update metadata
         self.metadata.update({
@@ -115,12 +135,20 @@ class IsolationForestAnomalyDetector:
         
         return metrics
     
-    def predict(self, X: np.ndarray) -> Dict[str, Any]:
+    def predict(
+        self,
+        X: np.ndarray,
+        return_numpy: bool = False,
+        compute_probability: bool = True
+    ) -> Dict[str, Any]:
         """
         Predict anomalies on new data.
         
         Args:
             X: Feature matrix
+            return_numpy: Return per-row results as NumPy arrays instead of lists
+            compute_probability: Include anomaly_probability; callers that only
+                need is_anomaly can skip the sigmoid
         
         Returns:
             Prediction results
@@ -133,59 +161,164 @@ class IsolationForestAnomalyDetector:
                 f"Feature dimension mismatch: expected {len(self.feature_names)}, got {X.shape[1]}"
             )
         
-        # Scale features
-        X_scaled = self.scaler.transform(X)
+        return self.predict_scaled(
+            self.scale(X),
+            return_numpy=return_numpy,
+            compute_probability=compute_probability
+        )
+    
+    def scale(self, X: np.ndarray) -> np.ndarray:
+        """Scale features in float32, the dtype the forest scores in."""
+        mean, inv_scale = self._scaling_stats()
+        X_scaled = np.subtract(X, mean, dtype=np.float32)
+        X_scaled *= inv_scale
+        return X_scaled
+    
+    def _scaling_stats(self) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Get the scaler's mean and reciprocal scale as float32 arrays.
+        
+        Scaling then stays in float32 and multiplies instead of dividing.
+        The arrays are cached until the scaler's statistics are replaced,
+        which also covers models saved with float64 statistics.
+        """
+        mean, scale = self.scaler.mean_, self.scaler.scale_
+        cached = self._scaling_cache
+        if cached is None or cached[0] is not mean or cached[1] is not scale:
+            cached = (mean, scale, mean.astype(np.float32), (1.0 / scale).astype(np.float32))
+            self._scaling_cache = cached
+        return cached[2], cached[3]
+    
+    def predict_scaled(
+        self,
+        X_scaled: np.ndarray,
+        return_numpy: bool = False,
+        compute_probability: bool = True
+    ) -> Dict[str, Any]:
+        """
+        Predict anomalies on features already scaled with this model's scaler.
+        
+        Args:
+            X_scaled: Scaled feature matrix, e.g. from scale()
+            return_numpy: Return per-row results as NumPy arrays instead of lists
+            compute_probability: Include anomaly_probability
+        
+        Returns:
+            Prediction results, as for predict()
+        """
+        if not self.is_trained:
+            raise ValueError("Model not trained. Call train() first.")
         
-        # Predict anomalies
-        predictions = self.model.predict(X_scaled)
+        # Score once; decision_function and predict are both derived from
+        # score_samples via offset_
         anomaly_scores = self.model.score_samples(X_scaled)
-        decision_scores = self.model.decision_function(X_scaled)
+        decision_scores = anomaly_scores - self.model.offset_
         
         # Convert to more intuitive format: 0 = normal, 1 = anomaly
-        is_anomaly = (predictions == -1).astype(int)
-        anomaly_probability = 1 / (1 + np.exp(-decision_scores))  # Sigmoid transform
+        is_anomaly = (decision_scores < 0).astype(np.int8)
         
         results = {
-            "is_anomaly": is_anomaly.tolist(),
-            "anomaly_score": anomaly_scores.tolist(),
-            "decision_score": decision_scores.tolist(),
-            "anomaly_probability": anomaly_probability.tolist(),
-            "predictions_count": len(predictions),
+            "is_anomaly": is_anomaly,
+            "anomaly_score": anomaly_scores,
+            "decision_score": decision_scores,
+            "predictions_count": len(anomaly_scores),
             "anomalies_count": int(np.sum(is_anomaly)),
             "anomaly_percentage": float(np.mean(is_anomaly) * 100)
         }
         
+        if compute_probability:
+            results["anomaly_probability"] = expit(decision_scores)  # Sigmoid transform
+        
         # Add feature contributions if available
         if hasattr(self.model, 'feature_importances_'):
             feature_importance = self.model.feature_importances_.tolist()
             results["feature_importance"] = dict(zip(self.feature_names, feature_importance))
         
+        if not return_numpy:
+            for key in ("is_anomaly", "anomaly_score", "decision_score", "anomaly_probability"):
+                if key in results:
+                    results[key] = results[key].tolist()
+        
         return results
     
+    def predict_json(self, X: np.ndarray) -> bytes:
+        """
+        Predict anomalies and serialize the results as JSON.
+        
+        The per-row arrays are written straight from NumPy without first
+        being converted into Python lists.
+        
+        Args:
+            X: Feature matrix
+        
+        Returns:
+            JSON-encoded prediction results
+        """
+        return orjson.dumps(self.predict(X, return_numpy=True), option=orjson.OPT_SERIALIZE_NUMPY)
+    
     def predict_single(self, features: Dict[str, float]) -> Dict[str, Any]:
         """
         Predict anomaly for a single record.
         
+        Scoring has a fixed per-call cost, so use predict_batch when
+        scoring several records.
+        
         Args:
             features: Dictionary of feature values
         
         Returns:
             Single prediction result
         """
-        # Convert to array
-        feature_vector = np.array([[features.get(f, 0) for f in self.feature_names]])
+        # Fill this thread's preallocated row in place; every slot is
+        # overwritten, so it never needs clearing
+        buffer = getattr(self._row_buffers, "row", None)
+        if buffer is None or buffer.shape[1] != len(self.feature_names):
+            buffer = self._row_buffers.row = np.zeros((1, len(self.feature_names)), dtype=np.float32)
+        row = buffer[0]
+        for i, name in enumerate(self.feature_names):
+            row[i] = features.get(name, 0)
+        
+        return self._batch_results([features], self.predict(buffer, return_numpy=True))[0]
+    
+    def predict_batch(self, records: List[Dict[str, float]]) -> List[Dict[str, Any]]:
+        """
+        Predict anomalies for several records in one scoring pass.
         
-        # Get predictions
-        results = self.predict(feature_vector)
+        Args:
+            records: Feature values per record; missing features default to 0
         
-        # Format single result
-        return {
-            "is_anomaly": bool(results["is_anomaly"][0]),
-            "anomaly_score": float(results["anomaly_score"][0]),
-            "anomaly_probability": float(results["anomaly_probability"][0]),
-            "features": features,
-            "model_name": self.model_name
-        }
+        Returns:
+            One prediction result per record, in order
+        """
+        if not records:
+            return []
+        
+        n_features = len(self.feature_names)
+        X = np.fromiter(
+            (record.get(name, 0) for record in records for name in self.feature_names),
+            dtype=np.float32,
+            count=len(records) * n_features
+        ).reshape(len(records), n_features)
+        
+        return self._batch_results(records, self.predict(X, return_numpy=True))
+    
+    def _batch_results(self, records: List[Dict[str, float]], results: Dict[str, Any]) -> List[Dict[str, Any]]:
+        """Pair each record with its entries from a return_numpy prediction."""
+        return [
+            {
+                "is_anomaly": is_anomaly,
+                "anomaly_score": score,
+                "anomaly_probability": probability,
+                "features": record,
+                "model_name": self.model_name
+            }
+            for record, is_anomaly, score, probability in zip(
+                records,
+                results["is_anomaly"].astype(bool).tolist(),
+                results["anomaly_score"].tolist(),
+                results["anomaly_probability"].tolist()
+            )
+        ]
     
     def save(self, model_dir: Optional[Path] = None) -> Path:
         """
@@ -211,22 +344,43 @@ class IsolationForestAnomalyDetector:
         metadata_path = model_dir / "metadata.json"
         features_path = model_dir / "features.json"
         
-        # Save objects
-        joblib.dump(self.model, model_path)
-        joblib.dump(self.scaler, scaler_path)
+        # Save objects uncompressed so load() can memory-map their arrays
+        self._replace_file(model_path, lambda path: joblib.dump(self.model, path))
+        self._replace_file(scaler_path, lambda path: joblib.dump(self.scaler, path))
         
         # Save metadata
-        with open(metadata_path, 'w') as f:
-            json.dump(self.metadata, f, indent=2)
+        self._replace_file(
+            metadata_path,
+            lambda path: path.write_bytes(orjson.dumps(self.metadata, option=JSON_OPTIONS))
+        )
         
         # Save features
-        with open(features_path, 'w') as f:
-            json.dump({"feature_names": self.feature_names}, f, indent=2)
+        self._replace_file(
+            features_path,
+            lambda path: path.write_bytes(orjson.dumps({"feature_names": self.feature_names}, option=JSON_OPTIONS))
+        )
         
         logger.info(f"Model saved to {model_dir}")
         
         return model_dir
     
+    @staticmethod
+    def _replace_file(path: Path, write) -> None:
+        """
+        Write a file next to its destination and rename it into place.
+        
+        Truncating a file that a loaded detector has memory-mapped would
+        pull its arrays out from under it; os.replace leaves the old file
+        alive until its mappings are closed.
+        
+        Args:
+            path: Destination file
+            write: Callable writing the content to the path it is given
+        """
+        tmp_path = path.with_name(path.name + ".tmp")
+        write(tmp_path)
+        os.replace(tmp_path, path)
+    
     def load(self, model_dir: Path) -> bool:
         """
         Load model from disk.
@@ -247,18 +401,18 @@ class IsolationForestAnomalyDetector:
                 logger.error(f"Missing model files in {model_dir}")
                 return False
             
-            # Load components
-            self.model = joblib.load(model_path)
-            self.scaler = joblib.load(scaler_path)
+            # Map the pickled arrays read-only instead of reading them onto the
+            # heap. The scaler's statistics stay mapped; sklearn copies each
+            # tree's node arrays into its own buffer when unpickling
+            self.model = joblib.load(model_path, mmap_mode='r')
+            self.scaler = joblib.load(scaler_path, mmap_mode='r')
             
             # Load metadata
-            with open(metadata_path, 'r') as f:
-                self.metadata = json.load(f)
+            self.metadata = orjson.loads(metadata_path.read_bytes())
             
             # Load features
-            with open(features_path, 'r') as f:
-                features_data = json.load(f)
-                self.feature_names = features_data["feature_names"]
+            features_data = orjson.loads(features_path.read_bytes())
+            self.feature_names = features_data["feature_names"]
             
             self.is_trained = True
             self.model_name = model_dir.name
@@ -303,37 +457,38 @@ class IsolationForestAnomalyDetector:
                 "message": "Record is not an anomaly"
             }
         
-        # Calculate feature deviations from training distribution
-        deviations = {}
-        for feature_name in self.feature_names:
-            feature_value = features.get(feature_name, 0)
-            
-            # Get training statistics from scaler
-            mean = self.scaler.mean_[self.feature_names.index(feature_name)]
-            std = self.scaler.scale_[self.feature_names.index(feature_name)]
-            
-            if std > 0:
-                z_score = abs((feature_value - mean) / std)
-                deviations[feature_name] = {
-                    "value": feature_value,
-                    "mean": float(mean),
-                    "std": float(std),
-                    "z_score": float(z_score),
-                    "deviation": float(z_score * std)
-                }
-        
-        # Sort by deviation
-        sorted_deviations = sorted(
-            deviations.items(),
-            key=lambda x: x[1]["z_score"],
-            reverse=True
-        )
+        # Calculate feature deviations from training distribution in one pass
+        values = [features.get(feature_name, 0) for feature_name in self.feature_names]
+        means = self.scaler.mean_
+        stds = self.scaler.scale_
+        with np.errstate(divide='ignore', invalid='ignore'):
+            z_scores = np.abs((np.asarray(values, dtype=np.float64) - means) / stds)
+        
+        # Select the top_n largest z-scores among features with spread
+        # without sorting all of them
+        candidates = np.flatnonzero(stds > 0)
+        k = max(0, min(top_n, len(candidates)))
+        if 0 < k < len(candidates):
+            candidates = candidates[np.argpartition(-z_scores[candidates], k - 1)[:k]]
+        top = candidates[np.argsort(-z_scores[candidates], kind='stable')][:k]
+        
+        top_features = {}
+        for i in top:
+            z_score = float(z_scores[i])
+            std = float(stds[i])
+            top_features[self.feature_names[i]] = {
+                "value": values[i],
+                "mean": float(means[i]),
+                "std": std,
+                "z_score": z_score,
+                "deviation": z_score * std
+            }
         
         explanation = {
             "is_anomaly": True,
             "anomaly_score": prediction["anomaly_score"],
             "anomaly_probability": prediction["anomaly_probability"],
-            "top_contributing_features": dict(sorted_deviations[:top_n]),
+            "top_contributing_features": top_features,
             "message": f"Record flagged as anomaly with score {prediction['anomaly_score']:.3f}"
         }
         
@@ -3,14 +3,16 @@ Shadow mode implementation for safe ML model deployment.
 """
 import pandas as pd
 import numpy as np
-from typing import Dict, List, Any, Optional, Tuple
+from collections import deque
+from itertools import islice
+from typing import Deque, Dict, List, Any, Optional, Tuple
 from datetime import datetime
-import json
 from pathlib import Path
+import orjson
 
 from shared.utils.logging import logger
 from services.ml_service.config import config
-from .isolation_forest import IsolationForestAnomalyDetector
+from .isolation_forest import IsolationForestAnomalyDetector, JSON_OPTIONS
 from .feature_extractor import FeatureExtractor
 
 
@@ -23,17 +25,35 @@ class ShadowModeManager:
         self.shadow_model: Optional[IsolationForestAnomalyDetector] = None
         self.feature_extractor = FeatureExtractor()
         self.is_active = config.shadow_mode_enabled
-        self.comparison_results: List[Dict[str, Any]] = []
+        
+        # Bounded history; the oldest entries are evicted on append
+        self.comparison_results: Deque[Dict[str, Any]] = deque(maxlen=config.shadow_max_comparisons)
         
         # Performance tracking
-        self.performance_metrics: Dict[str, List[float]] = {
-            "agreement_rate": [],
-            "production_anomaly_rate": [],
-            "shadow_anomaly_rate": [],
-            "false_positive_rate": [],
-            "false_negative_rate": []
+        self.performance_metrics: Dict[str, Deque[float]] = self._empty_metrics()
+    
+    @staticmethod
+    def _empty_metrics(history: Optional[Dict[str, List[float]]] = None) -> Dict[str, Deque[float]]:
+        """Create bounded performance metric series, optionally seeded from saved history."""
+        history = history or {}
+        return {
+            name: deque(history.get(name, ()), maxlen=config.shadow_max_metric_points)
+            for name in (
+                "agreement_rate",
+                "production_anomaly_rate",
+                "shadow_anomaly_rate",
+                "false_positive_rate",
+                "false_negative_rate"
+            )
         }
     
+    @staticmethod
+    def _recent(values: Deque, n: int) -> List:
+        """Last n entries of a deque, oldest first."""
+        recent = list(islice(reversed(values), n))
+        recent.reverse()
+        return recent
+    
     def initialize(self, production_model: IsolationForestAnomalyDetector):
         """Initialize shadow mode with production model."""
         self.production_model = production_model
@@ -84,27 +104,31 @@ class ShadowModeManager:
             raise ValueError("Models not trained")
         
         # Get predictions from both models
-        prod_results = self.production_model.predict(X)
-        shadow_results = self.shadow_model.predict(X)
+        if self._scalers_match():
+            # Identical scaling: transform once and score both models on it
+            X_scaled = self.production_model.scale(X)
+            prod_results = self.production_model.predict_scaled(X_scaled, return_numpy=True, compute_probability=False)
+            shadow_results = self.shadow_model.predict_scaled(X_scaled, return_numpy=True, compute_probability=False)
+        else:
+            prod_results = self.production_model.predict(X, return_numpy=True, compute_probability=False)
+            shadow_results = self.shadow_model.predict(X, return_numpy=True, compute_probability=False)
         
         # Compare predictions
-        prod_anomalies = np.array(prod_results["is_anomaly"])
-        shadow_anomalies = np.array(shadow_results["is_anomaly"])
+        prod_anomalies = prod_results["is_anomaly"]
+        shadow_anomalies = shadow_results["is_anomaly"]
+        
+        # Confusion matrix in one pass: code = production * 2 + shadow
+        codes = (prod_anomalies.astype(np.uint8) << 1) | shadow_anomalies.astype(np.uint8)
+        true_negatives, false_negatives, false_positives, true_positives = np.bincount(codes, minlength=4)
         
         # Calculate agreement metrics
-        agreement = np.sum(prod_anomalies == shadow_anomalies)
-        disagreement = np.sum(prod_anomalies != shadow_anomalies)
+        agreement = true_positives + true_negatives
+        disagreement = false_positives + false_negatives
         total = len(prod_anomalies)
         
         agreement_rate = agreement / total * 100
         disagreement_rate = disagreement / total * 100
         
-        # Calculate confusion matrix
-        true_positives = np.sum((prod_anomalies == 1) & (shadow_anomalies == 1))
-        false_positives = np.sum((prod_anomalies == 1) & (shadow_anomalies == 0))
-        false_negatives = np.sum((prod_anomalies == 0) & (shadow_anomalies == 1))
-        true_negatives = np.sum((prod_anomalies == 0) & (shadow_anomalies == 0))
-        
         # Calculate rates
         prod_anomaly_rate = np.mean(prod_anomalies) * 100
         shadow_anomaly_rate = np.mean(shadow_anomalies) * 100
@@ -162,6 +186,17 @@ class ShadowModeManager:
         
         return comparison
     
+    def _scalers_match(self) -> bool:
+        """Check whether both models apply the same feature scaling."""
+        prod_scaler = self.production_model.scaler
+        shadow_scaler = self.shadow_model.scaler
+        if prod_scaler is shadow_scaler:
+            return True
+        return (
+            np.array_equal(prod_scaler.mean_, shadow_scaler.mean_) and
+            np.array_equal(prod_scaler.scale_, shadow_scaler.scale_)
+        )
+    
     def promote_shadow_model(self) -> bool:
         """
         Promote shadow model to production.
@@ -179,7 +214,7 @@ class ShadowModeManager:
             return False
         
         # Calculate average agreement rate
-        recent_agreement = self.performance_metrics["agreement_rate"][-10:]
+        recent_agreement = self._recent(self.performance_metrics["agreement_rate"], 10)
         avg_agreement = np.mean(recent_agreement)
         
         if avg_agreement >= config.shadow_mode_threshold * 100:
@@ -206,16 +241,18 @@ class ShadowModeManager:
         if not self.performance_metrics["agreement_rate"]:
             return {"message": "No performance data available"}
         
+        recent_agreement = self._recent(self.performance_metrics["agreement_rate"], 10)
+        
         summary = {
             "total_comparisons": len(self.comparison_results),
             "average_agreement_rate": float(np.mean(self.performance_metrics["agreement_rate"])),
             "average_production_anomaly_rate": float(np.mean(self.performance_metrics["production_anomaly_rate"])),
             "average_shadow_anomaly_rate": float(np.mean(self.performance_metrics["shadow_anomaly_rate"])),
             "recent_performance": {
-                "last_10_agreement": [float(x) for x in self.performance_metrics["agreement_rate"][-10:]],
-                "last_10_avg_agreement": float(np.mean(self.performance_metrics["agreement_rate"][-10:])),
-                "promotion_ready": len(self.performance_metrics["agreement_rate"]) >= 10 and 
-                                  np.mean(self.performance_metrics["agreement_rate"][-10:]) >= config.shadow_mode_threshold * 100
+                "last_10_agreement": [float(x) for x in recent_agreement],
+                "last_10_avg_agreement": float(np.mean(recent_agreement)),
+                "promotion_ready": len(recent_agreement) >= 10 and 
+                                  np.mean(recent_agreement) >= config.shadow_mode_threshold * 100
             },
             "models": {
                 "production": self.production_model.get_model_info() if self.production_model else None,
@@ -228,31 +265,26 @@ class ShadowModeManager:
     def save_comparison_results(self, filepath: str):
         """Save comparison results to file."""
         results = {
-            "comparison_results": self.comparison_results,
-            "performance_metrics": self.performance_metrics,
+            "comparison_results": list(self.comparison_results),
+            "performance_metrics": {name: list(values) for name, values in self.performance_metrics.items()},
             "summary": self.get_performance_summary(),
             "saved_at": datetime.utcnow().isoformat()
         }
         
-        with open(filepath, 'w') as f:
-            json.dump(results, f, indent=2)
+        Path(filepath).write_bytes(orjson.dumps(results, option=JSON_OPTIONS))
         
         logger.info(f"Comparison results saved to {filepath}")
     
     def load_comparison_results(self, filepath: str) -> bool:
         """Load comparison results from file."""
         try:
-            with open(filepath, 'r') as f:
-                results = json.load(f)
+            results = orjson.loads(Path(filepath).read_bytes())
             
-            self.comparison_results = results.get("comparison_results", [])
-            self.performance_metrics = results.get("performance_metrics", {
-                "agreement_rate": [],
-                "production_anomaly_rate": [],
-                "shadow_anomaly_rate": [],
-                "false_positive_rate": [],
-                "false_negative_rate": []
-            })
+            self.comparison_results = deque(
+                results.get("comparison_results", []),
+                maxlen=config.shadow_max_comparisons
+            )
+            self.performance_metrics = self._empty_metrics(results.get("performance_metrics"))
             
             logger.info(f"Comparison results loaded from {filepath}")
             return True
@@ -277,7 +309,7 @@ class ShadowModeManager:
         # Collect all disagreements
         all_disagreements = []
         
-        for comparison in self.comparison_results[-100:]:  # Last 100 comparisons
+        for comparison in self._recent(self.comparison_results, 100):  # Last 100 comparisons
             if "disagreement_details" in comparison:
                 all_disagreements.extend(comparison["disagreement_details"])
         
@@ -33,11 +33,14 @@ class MLServiceConfig(BaseSettings):
     # ML Model settings
     models_dir: str = "data/models/ml_models"
     default_model: str = "isolation_forest_v1"
+    model_load_workers: int = 4  # Threads reading model directories at startup
     
     # Isolation Forest settings
     isolation_forest_contamination: float = 0.1
     isolation_forest_n_estimators: int = 100
     isolation_forest_max_samples: float = 0.8
+    n_jobs: int = -1  # Workers for forest fitting (-1 = all cores)
+    forest_backend: str = "loky"  # joblib backend for fitting: loky (processes), threading
     
     # Feature extraction
     max_features: int = 50
@@ -52,6 +55,8 @@ class MLServiceConfig(BaseSettings):
     # Shadow mode
     shadow_mode_enabled: bool = True
     shadow_mode_threshold: float = 0.7
+    shadow_max_comparisons: int = 10000  # Comparison results kept in memory
+    shadow_max_metric_points: int = 1000  # Points kept per tracked performance metric
     
     class Config:
         env_file = ".env"
@@ -4,6 +4,7 @@ ML Service - Anomaly detection and machine learning features.
 """
 from fastapi import FastAPI, HTTPException, status
 from contextlib import asynccontextmanager
+import asyncio
 import time
 
 from shared.utils.logging import logger
@@ -35,7 +36,8 @@ async def lifespan(app: FastAPI):
     # Initialize ML models
     try:
         from services.ml_service.models.model_manager import model_manager
-        model_manager.load_all_models()
+        # Load off the event loop so startup is not blocked on disk reads
+        await asyncio.to_thread(model_manager.load_all_models)
         logger.info("ML models initialized")
     except Exception as e:
         logger.error(f"ML model initialization failed: {str(e)}")
@@ -2,7 +2,8 @@
 Model manager for ML models.
 """
 import json
-from typing import Dict, List, Any, Optional
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List, Any, Optional, Tuple
 from pathlib import Path
 from datetime import datetime
 import numpy as np
@@ -36,29 +37,23 @@ class ModelManager:
         """
         loaded_count = 0
         
-        # Scan models directory
-        for model_dir in self.models_dir.iterdir():
-            if model_dir.is_dir():
-                try:
-                    # Check if this is a valid model directory
-                    model_files = list(model_dir.glob("*"))
-                    if any(f.name == "model.joblib" for f in model_files):
-                        # Load model
-                        model = IsolationForestAnomalyDetector(model_name=model_dir.name)
-                        if model.load(model_dir):
-                            self.models[model_dir.name] = model
-                            loaded_count += 1
-                            
-                            # Load feature extractor if available
-                            feature_config = model_dir / "feature_config.json"
-                            if feature_config.exists():
-                                feature_extractor = FeatureExtractor()
-                                if feature_extractor.load_config(str(feature_config)):
-                                    self.feature_extractors[model_dir.name] = feature_extractor
-                            
-                            logger.info(f"Loaded model: {model_dir.name}")
-                except Exception as e:
-                    logger.error(f"Error loading model from {model_dir}: {str(e)}")
+        # Scan models directory; loading is mostly file I/O, so read the
+        # model directories concurrently
+        model_dirs = [model_dir for model_dir in self.models_dir.iterdir() if model_dir.is_dir()]
+        with ThreadPoolExecutor(max_workers=config.model_load_workers) as executor:
+            results = list(executor.map(self._load_model_dir, model_dirs))
+        
+        for model_dir, result in zip(model_dirs, results):
+            if result is None:
+                continue
+            
+            model, feature_extractor = result
+            self.models[model_dir.name] = model
+            if feature_extractor is not None:
+                self.feature_extractors[model_dir.name] = feature_extractor
+            loaded_count += 1
+            
+            logger.info(f"Loaded model: {model_dir.name}")
         
         # Initialize shadow mode for default model
         if config.default_model in self.models and config.shadow_mode_enabled:
@@ -67,6 +62,43 @@ class ModelManager:
         logger.info(f"Loaded {loaded_count} models")
         return loaded_count
     
+    def _load_model_dir(
+        self,
+        model_dir: Path
+    ) -> Optional[Tuple[IsolationForestAnomalyDetector, Optional[FeatureExtractor]]]:
+        """
+        Load a model and its feature extractor from a model directory.
+        
+        Args:
+            model_dir: Directory to load from
+        
+        Returns:
+            Tuple of (model, feature_extractor or None), or None if the
+            directory holds no loadable model
+        """
+        try:
+            # Check if this is a valid model directory
+            if not (model_dir / "model.joblib").exists():
+                return None
+            
+            # Load model
+            model = IsolationForestAnomalyDetector(model_name=model_dir.name)
+            if not model.load(model_dir):
+                return None
+            
+            # Load feature extractor if available
+            feature_extractor = None
+            feature_config = model_dir / "feature_config.json"
+            if feature_config.exists():
+                feature_extractor = FeatureExtractor()
+                if not feature_extractor.load_config(str(feature_config)):
+                    feature_extractor = None
+            
+            return model, feature_extractor
+        except Exception as e:
+            logger.error(f"Error loading model from {model_dir}: {str(e)}")
+            return None
+    
     def get_model(self, model_name: str) -> Optional[IsolationForestAnomalyDetector]:
         """Get model by name."""
         return self.models.get(model_name)
@@ -0,0 +1,26 @@
+"""add usage and file composite indexes
+
+Revision ID: 4f2a9c1d7e83
+Revises: bdeec47b9879
+Create Date: 2026-10-17 10:12:41.318204
+
+"""
+from alembic import op
+import sqlalchemy as sa
+from sqlalchemy.dialects import postgresql
+
+# revision identifiers, used by Alembic.
+revision = '4f2a9c1d7e83'
+down_revision = 'bdeec47b9879'
+branch_labels = None
+depends_on = None
+
+
+def upgrade() -> None:
+    op.create_index('ix_usage_records_tenant_recorded_at', 'usage_records', ['tenant_id', 'recorded_at'], unique=False)
+    op.create_index('ix_files_tenant_status_created_at', 'files', ['tenant_id', 'status', 'created_at'], unique=False)
+
+
+def downgrade() -> None:
+    op.drop_index('ix_files_tenant_status_created_at', table_name='files')
+    op.drop_index('ix_usage_records_tenant_recorded_at', table_name='usage_records')
@@ -0,0 +1,80 @@
+"""
+Query counting helpers for spotting N+1 regressions on hot paths.
+"""
+import functools
+import threading
+from contextlib import contextmanager
+from typing import Any, Callable, Generator, List, Optional
+
+from sqlalchemy import event
+
+from shared.database.base import engine
+from shared.utils.config import settings
+from shared.utils.logging import logger
+
+
+@contextmanager
+def count_queries(conn: Any = engine) -> Generator[List[str], None, None]:
+    """
+    Record SQL statements executed on a connection or engine.
+
+    Only statements issued from the calling thread are recorded, so
+    background threads sharing the engine do not skew the count. Work
+    handed to other threads (e.g. an executor) must be counted there.
+
+    Args:
+        conn: Engine or connection to listen on
+
+    Yields:
+        List that collects the executed statements
+    """
+    queries: List[str] = []
+    thread_id = threading.get_ident()
+
+    def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        if threading.get_ident() == thread_id:
+            queries.append(statement)
+
+    event.listen(conn, "before_cursor_execute", _before_cursor_execute)
+    try:
+        yield queries
+    finally:
+        event.remove(conn, "before_cursor_execute", _before_cursor_execute)
+
+
+def query_budget(max_queries: Optional[int] = None) -> Callable:
+    """
+    Log how many queries a function issues and warn above a budget.
+
+    Counting is only enabled when ``settings.debug`` is set; otherwise the
+    function is returned unchanged.
+
+    Args:
+        max_queries: Warn when a call issues more queries than this
+    """
+    def decorator(func: Callable) -> Callable:
+        if not settings.debug:
+            return func
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with count_queries() as queries:
+                result = func(*args, **kwargs)
+
+            logger.debug(
+                "Query count",
+                function=func.__qualname__,
+                queries=len(queries)
+            )
+            if max_queries is not None and len(queries) > max_queries:
+                logger.warning(
+                    "Query budget exceeded",
+                    function=func.__qualname__,
+                    queries=len(queries),
+                    budget=max_queries
+                )
+            return result
+
+        return wrapper
+
+    return decorator
@@ -53,6 +53,24 @@ class DatabaseSessionManager:
 def get_db_session() -> Generator[Session, None, None]:
     """FastAPI dependency for database sessions."""
     session = SessionLocal()
+    try:
+        yield session
+    finally:
+        session.close()
+
+
+@contextmanager
+def db_session_scope() -> Generator[Session, None, None]:
+    """
+    Context manager for a plain database session.
+    
+    Unlike get_session, this neither commits nor rolls back; callers manage
+    their own transactions and the session is always closed on exit.
+    
+    Yields:
+        Database session
+    """
+    session = SessionLocal()
     try:
         yield session
     finally:
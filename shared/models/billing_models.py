@@ -123,6 +123,7 @@ class UsageRecord(TenantBaseModel):
     __table_args__ = (
         Index('ix_usage_records_metric_name', 'metric_name'),
         Index('ix_usage_records_recorded_at', 'recorded_at'),
+        Index('ix_usage_records_tenant_recorded_at', 'tenant_id', 'recorded_at'),
     )
     
     def __repr__(self):
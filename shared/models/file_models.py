@@ -47,6 +47,7 @@ class File(TenantBaseModel):
         Index('ix_files_status', 'status'),
         Index('ix_files_uploaded_by', 'uploaded_by'),
         Index('ix_files_created_at', 'created_at'),
+        Index('ix_files_tenant_status_created_at', 'tenant_id', 'status', 'created_at'),
     )
     
     def __repr__(self):